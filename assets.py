@@ -0,0 +1,129 @@
+import glob
+import time
+from pathlib import Path
+import pygame as pg
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+from settings import TILE_SIZE
+from tools import load_img
+
+
+def pack(sizes: dict[str, tuple[int, int]], width: int) -> tuple[dict[str, pg.Rect], int]:
+    """
+    Shelf packs rects of sizes into rows width wide, tallest first. Returns
+    the rect of every key and the height it took
+    """
+    rects = {}
+    x = y = shelf_height = 0
+    for key, (w, h) in sorted(sizes.items(), key=lambda item: -item[1][1]):
+        if x + w > width and x > 0:
+            x, y = 0, y + shelf_height
+            shelf_height = 0
+        rects[key] = pg.Rect(x, y, w, h)
+        x += w
+        shelf_height = max(shelf_height, h)
+    return rects, y + shelf_height
+
+
+class Assets:
+    """
+    Decodes the textures and sounds on a worker thread while main shows the
+    loading screen, every file gets a future that's done once it's decoded.
+    build_atlas then packs all the textures into one surface, texture hands
+    out subsurfaces of it so everything gets blitted from the same pixels.
+
+    Asking for something that wasn't preloaded loads it on the spot, misses
+    counts how often that happened since every time is a hitch
+    """
+
+    def __init__(self, atlas_width: int = 16 * TILE_SIZE):
+        self.atlas_width = atlas_width
+        # path -> future of the decoded but not yet converted surface / the sound
+        self.futures: dict[str, Future] = {}
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.atlas: Optional[pg.Surface] = None
+        # path -> subsurface of the atlas, or a surface loaded on a miss
+        self.textures: dict[str, pg.Surface] = {}
+        self.sounds: dict[str, pg.mixer.Sound] = {}
+        self.misses = 0
+        self.start_time = 0.0
+        self.load_time = 0.0
+
+    def start(self, textures: str = "textures/**/*.png", sounds: str = "sounds/*.wav"):
+        """
+        Starts decoding every file matching the globs, needs the mixer to be
+        initialized for the sounds
+        """
+        self.start_time = time.perf_counter()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="assets")
+        # keyed by forward slash paths, glob hands out backslashes on windows
+        for path in sorted(glob.glob(textures, recursive=True)):
+            self.futures[Path(path).as_posix()] = self.executor.submit(pg.image.load, path)
+        for path in sorted(glob.glob(sounds)):
+            self.futures[Path(path).as_posix()] = self.executor.submit(pg.mixer.Sound, path)
+        self.executor.shutdown(wait=False)
+
+    def progress(self) -> float:
+        if not self.futures:
+            return 1.0
+        return sum(future.done() for future in self.futures.values()) / len(self.futures)
+
+    @property
+    def ready(self) -> bool:
+        return all(future.done() for future in self.futures.values())
+
+    def build_atlas(self):
+        """
+        Waits for the textures and packs them scaled to TILE_SIZE into the
+        atlas, needs the display mode to be set
+        """
+        images = {
+            path: pg.transform.scale_by(future.result().convert_alpha(), TILE_SIZE / 16)
+            for path, future in self.futures.items()
+            if path.endswith(".png")
+        }
+        rects, height = pack(
+            {path: img.get_size() for path, img in images.items()}, self.atlas_width
+        )
+        self.atlas = pg.Surface((self.atlas_width, max(height, 1)), pg.SRCALPHA)
+        # the atlas starts out empty, RGBA_MAX copies the pixels without blending
+        self.atlas.fblits(
+            [(img, rects[path]) for path, img in images.items()], pg.BLEND_RGBA_MAX
+        )
+        for path, rect in rects.items():
+            self.textures[path] = self.atlas.subsurface(rect)
+        for path, future in self.futures.items():
+            if not path.endswith(".png"):
+                self.sounds[path] = future.result()
+        self.load_time = time.perf_counter() - self.start_time
+
+    def texture(self, path: str) -> pg.Surface:
+        # normalizing is slow next to the dict get, only do it when the path misses
+        if (img := self.textures.get(path)) is None:
+            key = Path(path).as_posix()
+            if (img := self.textures.get(key)) is None:
+                self.misses += 1
+                img = self.textures[key] = load_img(path)
+            self.textures[path] = img
+        return img
+
+    def sound(self, path: str) -> pg.mixer.Sound:
+        if (sound := self.sounds.get(path)) is None:
+            key = Path(path).as_posix()
+            if (sound := self.sounds.get(key)) is None:
+                if (future := self.futures.get(key)) is not None:
+                    sound = future.result()
+                else:
+                    self.misses += 1
+                    sound = pg.mixer.Sound(path)
+                self.sounds[key] = sound
+            self.sounds[path] = sound
+        return sound
+
+    def atlas_bytes(self) -> int:
+        if self.atlas is None:
+            return 0
+        return self.atlas.get_width() * self.atlas.get_height() * self.atlas.get_bytesize()
+
+
+assets = Assets()
@@ -0,0 +1,306 @@
+"""
+Scripted scenarios with a fixed seed, timed phase by phase and compared
+against benchmark_baseline.json.
+
+    python benchmark.py                 run everything and compare
+    python benchmark.py lights water    run some scenarios
+    python benchmark.py --save          record the results as the new baseline
+
+Exits with 1 when a phase got slower (or allocates more) than the baseline
+allows, see --tolerance
+"""
+
+import os
+
+# rendering scenarios draw offscreen, no window needed
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import gc
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import numpy as np
+import pygame as pg
+
+from settings import WIDTH, HEIGHT, TILE_SIZE, SIM_RATE, STREAM_DISTANCE
+from assets import assets
+from tilemap import Tilemap
+from streaming_tilemap import StreamingTilemap
+from tiles import Tiles
+from world import World, EXPLOSION_COLORS
+from world_gen import WorldGenerator
+from game_object import GameObject
+from player import Enemy1
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+SEED = 1234
+
+
+class Bench:
+    """
+    Collects the phases of one scenario run. With trace_memory every phase
+    also records the peak of python and numpy allocations above what was
+    allocated when it started (SDL surfaces aren't traced)
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        # phase -> seconds or peak bytes
+        self.times: dict[str, float] = {}
+        self.memory: dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.times[name] = time.perf_counter() - start
+        if self.trace_memory:
+            self.memory[name] = tracemalloc.get_traced_memory()[1] - start_bytes
+
+
+# name -> scenario, a scenario sets up untimed and runs its phases in bench.phase
+SCENARIOS: dict[str, Callable[[Bench], None]] = {}
+
+
+def scenario(fn: Callable[[Bench], None]):
+    SCENARIOS[fn.__name__] = fn
+    return fn
+
+
+def new_world(render: bool = False) -> World:
+    return World(pg.Surface((WIDTH, HEIGHT)) if render else None, None, SEED)
+
+
+@scenario
+def worldgen(bench: Bench):
+    tilemap = Tilemap(5000, 500)
+    with bench.phase("generate"):
+        WorldGenerator(tilemap, SEED).generate_tiles(workers=1)
+    with bench.phase("light"):
+        tilemap.tile_light.update()
+
+
+@scenario
+def particles(bench: Bench):
+    world = new_world()
+    dt = 1 / SIM_RATE
+    world.dt = dt
+    explosion = GameObject(*world.player.pos)
+    with bench.phase("emit"):
+        # 40 particles each
+        for _ in range(250):
+            world.explosion_particles([explosion])
+    with bench.phase("update"):
+        for _ in range(60):
+            world.pm.update(world)
+
+
+@scenario
+def enemies(bench: Bench):
+    world = new_world()
+    rng = np.random.default_rng(SEED)
+    with bench.phase("spawn"):
+        for dx, dy in rng.uniform((-40, 5), (40, 15), (500, 2)).tolist():
+            world.layer0.append(Enemy1(*(world.player.pos - pg.Vector2(dx, dy)), world))
+    with bench.phase("update"):
+        for _ in range(300):
+            world.update(1 / SIM_RATE)
+
+
+@scenario
+def water(bench: Bench):
+    world = new_world()
+    tilemap = world.tilemap
+    x0 = int(world.player.pos.x) - 20
+    # a 40x20 block of water right above the highest ground
+    solid = Tiles.collidable[tilemap.get_region(x0, 0, 40, tilemap.height)]
+    y0 = int(np.argmax(solid.any(axis=1))) - 20
+    with bench.phase("pour"):
+        for y in range(y0, y0 + 20):
+            for x in range(x0, x0 + 40):
+                tilemap.set_tile((x, y), Tiles.WATER)
+    world.dt = 1 / SIM_RATE
+    with bench.phase("flow"):
+        for _ in range(600):
+            tilemap.update(world)
+
+
+@scenario
+def tilemap_draw(bench: Bench):
+    world = new_world(render=True)
+    camera = world.player.pos - pg.Vector2(WIDTH, HEIGHT) / (2 * TILE_SIZE)
+    with bench.phase("first"):
+        world.tilemap.draw(world.surf, -camera)
+    with bench.phase("pan"):
+        for _ in range(600):
+            camera.x += 0.5
+            world.tilemap.draw(world.surf, -camera)
+
+
+@scenario
+def streaming(bench: Bench):
+    path = os.path.join(tempfile.mkdtemp(prefix="sandbox2d_bench_"), "stream.s2d")
+    tilemap = StreamingTilemap(500, SEED)
+    tilemap.load_columns(-STREAM_DISTANCE, STREAM_DISTANCE)
+    tilemap.save(path)
+    tilemap.world_file.close()
+    with bench.phase("load"):
+        world = World(None, path, SEED)
+    with bench.phase("walk"):
+        # far enough that chunks get unloaded and written back
+        for _ in range(300):
+            world.player.pos.x += 20
+            world.tilemap.set_tile(world.player.pos, None)
+            world.update(1 / SIM_RATE)
+    world.tilemap.save(wait=True)
+
+
+@scenario
+def lights(bench: Bench):
+    world = new_world(render=True)
+    world.camera.xy = world.player.pos - pg.Vector2(WIDTH, HEIGHT) / (2 * TILE_SIZE)
+    rng = np.random.default_rng(SEED)
+    n = 2000
+    screen_tiles = np.array([WIDTH, HEIGHT]) / TILE_SIZE
+    with bench.phase("add"):
+        added = world.lm.add_many(
+            n,
+            rng.integers(10, 80, n),
+            np.asarray(world.camera) + rng.uniform(0, 1, (n, 2)) * screen_tiles,
+            EXPLOSION_COLORS[rng.integers(0, 3, n)],
+        )
+    slots = [light.slot for light in added]
+    with bench.phase("first"):
+        world.lm.draw(world)
+    with bench.phase("draw"):
+        for _ in range(120):
+            world.lm.pos[slots] += rng.uniform(-0.1, 0.1, (n, 2))
+            world.lm.draw(world)
+
+
+def run(name: str, repeat: int) -> dict[str, dict[str, float]]:
+    """
+    Best time of repeat runs and the peak memory of one more traced run,
+    as {phase: {"ms": ..., "peak_kib": ...}}
+    """
+    times: dict[str, float] = {}
+    for _ in range(repeat):
+        random.seed(SEED)
+        bench = Bench()
+        SCENARIOS[name](bench)
+        for phase, seconds in bench.times.items():
+            times[phase] = min(times.get(phase, seconds), seconds)
+
+    random.seed(SEED)
+    bench = Bench(trace_memory=True)
+    tracemalloc.start()
+    try:
+        SCENARIOS[name](bench)
+    finally:
+        tracemalloc.stop()
+    return {
+        phase: {"ms": times[phase] * 1000, "peak_kib": bench.memory[phase] / 1024}
+        for phase in times
+    }
+
+
+def compare(
+    results: dict, baseline: dict, tolerance: float, memory_tolerance: float
+) -> list[str]:
+    """
+    Lines for every phase over its baseline
+    """
+    regressions = []
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            base = baseline.get(name, {}).get(phase)
+            if base is None:
+                continue
+            # short phases jitter by a couple of milliseconds
+            if result["ms"] > base["ms"] * (1 + tolerance) + 2:
+                regressions.append(
+                    f"{name}.{phase}: {result['ms']:.1f}ms, baseline {base['ms']:.1f}ms"
+                )
+            # and allocate a few KiB more or less
+            if result["peak_kib"] > base["peak_kib"] * (1 + memory_tolerance) + 64:
+                regressions.append(
+                    f"{name}.{phase}: {result['peak_kib']:.0f}KiB peak, baseline {base['peak_kib']:.0f}KiB"
+                )
+    return regressions
+
+
+def report(results: dict, baseline: dict):
+    print(f"{'phase':<24}{'ms':>10}{'base ms':>10}{'change':>9}{'peak KiB':>11}")
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            base = baseline.get(name, {}).get(phase)
+            line = f"{name + '.' + phase:<24}{result['ms']:>10.1f}"
+            if base is None:
+                line += f"{'-':>10}{'-':>9}"
+            else:
+                change = (result["ms"] / base["ms"] - 1) * 100 if base["ms"] else 0
+                line += f"{base['ms']:>10.1f}{change:>+8.0f}%"
+            print(line + f"{result['peak_kib']:>11.0f}")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="run the benchmark scenarios")
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed slowdown, 0.3 is 30%%")
+    parser.add_argument("--memory-tolerance", type=float, default=0.3)
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    pg.display.init()
+    # textures get converted for the display format
+    pg.display.set_mode((1, 1))
+    # tiles draw from the atlas like in the game, sounds aren't needed
+    assets.start(sounds="")
+    assets.build_atlas()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        print(f"running {name}")
+        results[name] = run(name, args.repeat)
+    print()
+    report(results, baseline)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"\nsaved baseline to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if regressions:
+        print("\nREGRESSIONS")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import pygame as pg
+import numpy as np
+from collections import OrderedDict
+from settings import TILE_SIZE, CHUNK_SIZE, MAX_CACHED_CHUNKS
+from tiles import Tiles, Water
+from water import water_levels
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tilemap import Tilemap
+
+
+class ChunkCache:
+    """
+    Pre-rendered CHUNK_SIZE x CHUNK_SIZE tile surfaces, drawing the tilemap
+    only blits the chunks on screen. Chunks are re-rendered when marked dirty
+    and the least recently drawn ones get evicted when over max_chunks
+    """
+
+    def __init__(
+        self,
+        tilemap: "Tilemap",
+        chunk_size: int = CHUNK_SIZE,
+        max_chunks: int = MAX_CACHED_CHUNKS,
+    ):
+        self.tilemap = tilemap
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks: OrderedDict[tuple[int, int], pg.Surface] = OrderedDict()
+        self.dirty: set[tuple[int, int]] = set()
+
+    def invalidate(self, x: int, y: int):
+        key = (x // self.chunk_size, y // self.chunk_size)
+        if key in self.chunks:
+            self.dirty.add(key)
+
+    def invalidate_rect(self, x: int, y: int, w: int, h: int):
+        if w <= 0 or h <= 0:
+            return
+        cs = self.chunk_size
+        for cy in range(y // cs, (y + h - 1) // cs + 1):
+            for cx in range(x // cs, (x + w - 1) // cs + 1):
+                if (cx, cy) in self.chunks:
+                    self.dirty.add((cx, cy))
+
+    def invalidate_cells(self, xs: np.ndarray, ys: np.ndarray):
+        if not self.chunks or len(xs) == 0:
+            return
+        keys = np.unique(np.stack([xs // self.chunk_size, ys // self.chunk_size]), axis=1)
+        for key in zip(*keys.tolist()):
+            if key in self.chunks:
+                self.dirty.add(key)
+
+    def clear(self):
+        self.dirty.update(self.chunks)
+
+    def new_surface(self) -> pg.Surface:
+        size = self.chunk_size * TILE_SIZE
+        return pg.Surface((size, size), pg.SRCALPHA)
+
+    def render_chunk(self, key: tuple[int, int], surf: pg.Surface):
+        cs = self.chunk_size
+        x0, y0 = key[0] * cs, key[1] * cs
+        region = self.tilemap.get_region(x0, y0, cs, cs)
+        ys, xs = region.nonzero()
+        ids = region[ys, xs].tolist()
+        water_id = Tiles.WATER.id
+        if water_id in ids:
+            stored = self.tilemap.get_water_region(x0, y0, region.shape[1], region.shape[0])
+            levels = water_levels(region, stored)[ys, xs].tolist()
+        else:
+            levels = [0] * len(ids)
+        registry = Tiles.registry
+
+        surf.fill((0, 0, 0, 0))
+        # cells never overlap and the surface starts out empty, so BLEND_RGBA_MAX
+        # copies the tile pixels as is instead of blending their alpha twice
+        surf.fblits(
+            [
+                (
+                    Water.level_img(level)
+                    if tile_id == water_id
+                    else registry[tile_id].img,
+                    (x * TILE_SIZE, y * TILE_SIZE),
+                )
+                for x, y, tile_id, level in zip(xs.tolist(), ys.tolist(), ids, levels)
+            ],
+            pg.BLEND_RGBA_MAX,
+        )
+
+    def get_chunk(self, key: tuple[int, int]) -> pg.Surface:
+        if surf := self.chunks.get(key):
+            self.chunks.move_to_end(key)
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.render_chunk(key, surf)
+            return surf
+
+        if len(self.chunks) >= self.max_chunks:
+            # reuse the least recently drawn surface
+            old_key, surf = self.chunks.popitem(last=False)
+            self.dirty.discard(old_key)
+        else:
+            surf = self.new_surface()
+        self.render_chunk(key, surf)
+        self.chunks[key] = surf
+        return surf
+
+    def draw(self, surf: pg.Surface, camera: pg.Vector2 = pg.Vector2(0, 0)):
+        cs = self.chunk_size
+        w, h = surf.get_size()
+        cx_start = int(-camera.x // cs)
+        cx_end = int((-camera.x + w / TILE_SIZE) // cs)
+        # streamed tilemaps have no width
+        if self.tilemap.width is not None:
+            cx_start = max(0, cx_start)
+            cx_end = min((self.tilemap.width - 1) // cs, cx_end)
+        cy_start = max(0, int(-camera.y // cs))
+        cy_end = min(
+            (self.tilemap.height - 1) // cs, int((-camera.y + h / TILE_SIZE) // cs)
+        )
+
+        surf.fblits(
+            [
+                (
+                    self.get_chunk((cx, cy)),
+                    ((cx * cs + camera.x) * TILE_SIZE, (cy * cs + camera.y) * TILE_SIZE),
+                )
+                for cy in range(cy_start, cy_end + 1)
+                for cx in range(cx_start, cx_end + 1)
+            ]
+        )
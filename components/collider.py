@@ -1,39 +1,92 @@
 from typing import Any
 from .base import Component, System
 import pygame as pg
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Optional
 from settings import Tags
 class ColliderSystem(System):
-    def __init__(self):
+    """
+    Keeps colliders in a uniform grid of cell_size tiles. A collider sits in
+    every cell its rect touches and only gets moved to other cells when the
+    cells it touches change, so queries only look at nearby colliders
+    """
+
+    def __init__(self, cell_size: int = 2):
         super().__init__()
-        self.collision_dict = {}
-
-    def update_collision_dict(self):
-        collision_dict: Dict[Tuple[float, float], list["Collider"]] = {}
-        for obj in self.components:
-            for i in obj.get_corner_tile_positions():
-                if i in collision_dict:
-                    collision_dict[i].append(obj)
-                else:
-                    collision_dict[i] = [obj]
-        self.collision_dict = collision_dict
-    
+        self.cell_size = cell_size
+        # cell -> colliders touching it
+        self.cells: Dict[Tuple[int, int], set["Collider"]] = {}
+
+    def cell_range(self, rect: pg.FRect) -> Tuple[int, int, int, int]:
+        """
+        (x0, y0, x1, y1) of the cells the rect touches, inclusive
+        """
+        cs = self.cell_size
+        return (
+            int(rect.left // cs),
+            int(rect.top // cs),
+            int(rect.right // cs),
+            int(rect.bottom // cs),
+        )
+
+    def range_cells(self, cell_range: Tuple[int, int, int, int]):
+        x0, y0, x1, y1 = cell_range
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                yield (x, y)
+
+    def insert(self, collider: "Collider", cell_range: Tuple[int, int, int, int]):
+        for cell in self.range_cells(cell_range):
+            if cell in self.cells:
+                self.cells[cell].add(collider)
+            else:
+                self.cells[cell] = {collider}
+        collider.cell_range = cell_range
+
+    def remove(self, collider: "Collider"):
+        if collider.cell_range is None:
+            return
+        for cell in self.range_cells(collider.cell_range):
+            bucket = self.cells[cell]
+            bucket.discard(collider)
+            if not bucket:
+                del self.cells[cell]
+        collider.cell_range = None
+
     def update(self):
-        self.components = [i for i in self.components if i.update()]
-        self.update_collision_dict()
-        
+        alive = []
+        for collider in self.components:
+            if not collider.update():
+                self.remove(collider)
+                continue
+            alive.append(collider)
+            cell_range = self.cell_range(collider.rect)
+            if cell_range != collider.cell_range:
+                self.remove(collider)
+                self.insert(collider, cell_range)
+        self.components = alive
+
+    def candidates(self, rect: pg.FRect) -> set["Collider"]:
+        """
+        Colliders in the cells the rect touches, they don't have to overlap it
+        """
+        found = set()
+        for cell in self.range_cells(self.cell_range(rect)):
+            if bucket := self.cells.get(cell):
+                found.update(bucket)
+        return found
+
+    def query_rect(self, rect: pg.FRect) -> list["Collider"]:
+        return [col for col in self.candidates(rect) if rect.colliderect(col.rect)]
 
     def get_entity_collisions(self, collider: "Collider") -> list["Collider"]:
-        collisions: list["Collider"] = []
-        for pos in collider.get_corner_tile_positions():
-            colls = self.collision_dict.get(pos)
-            if not colls: continue
-            for col in colls:
-                if col != collider:
-                    if (col.tags == [] or collider.owner.tag in col.tags) and collider.rect.colliderect(col.rect) and col not in collisions:
-                        collisions.append(col)
-        return collisions
-    
+        return [
+            col
+            for col in self.candidates(collider.rect)
+            if col is not collider
+            and (col.tags == [] or collider.owner.tag in col.tags)
+            and collider.rect.colliderect(col.rect)
+        ]
+
 
 class Collider(Component):
     def __init__(self, w, h, owner, collider_system : ColliderSystem, tags : list[Tags] = []) -> None:
@@ -42,7 +95,8 @@ class Collider(Component):
         self.tags = tags
         print(self.tags)
         self.rect.center = self.owner.pos
-        collider_system.components.append(self)
+        # cells it's in, see ColliderSystem
+        self.cell_range: Optional[Tuple[int, int, int, int]] = None
 
     def update(self) -> bool:
         self.rect.center = self.owner.pos
@@ -4,7 +4,6 @@ import pygame as pg
 from .base import System, Component
 from .physics import PhysicsComponent
 from .collider import Collider
-from event import post_event
 from projectile import Projectile
 import random
 import math
@@ -58,16 +57,16 @@ class PlayerInputComponent(Component):
             self.dash(game_object, world, pg.Vector2(-10, 0))
 
         if keys[pg.K_SPACE] and game_object.components[PhysicsComponent].grounded:
-            self.jump(game_object)
+            self.jump(game_object, world)
 
     def dash(self, game_object: "Player2", world: "World", vec: pg.Vector2):
         self.can_dash = False
         game_object.components[PhysicsComponent].apply_impulse(vec)
-        post_event("player_dash", {"game_object": game_object, "vec": vec})
+        world.events.post("player_dash", {"game_object": game_object, "vec": vec})
 
-    def jump(self, game_object):
+    def jump(self, game_object: "Player2", world: "World"):
         game_object.components[PhysicsComponent].apply_impulse(pg.Vector2(0, -13))
-        post_event("player_jump", game_object)
+        world.events.post("player_jump", game_object, coalesce=True)
 
     def right_click(self, world: "World", game_object: "Player2"):
         game_object.equipped_stack.right_click(world, self)
@@ -1,42 +1,264 @@
 from components.base import System
 from .base import System, Component
 import pygame as pg
+import numpy as np
 from settings import TILE_SIZE, Tags
-import math
 import random
+from tiles import Tiles
 from .collider import Collider
-from event import post_event
 
 
 class PhysicsSystem(System):
-    def __init__(self):
+    """
+    Integrates every body at once. Positions, velocities, sizes and the forces
+    collected since the last update live in numpy arrays, one row per
+    PhysicsComponent (see PhysicsComponent.index). Bodies get pushed apart
+    from the colliders they overlap and collide with tiles one axis at a time
+    """
+
+    array_names = ("pos", "vel", "size", "force", "impulse", "last_force", "grounded")
+
+    def __init__(self, capacity: int = 64):
         super().__init__()
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.size = np.zeros((capacity, 2))
+        self.force = np.zeros((capacity, 2))
+        self.impulse = np.zeros((capacity, 2))
+        self.last_force = np.zeros((capacity, 2))
+        self.grounded = np.zeros(capacity, dtype=bool)
+        # (component, force x, target x velocity) from apply_force_target
+        self.target_forces: list[tuple["PhysicsComponent", float, float]] = []
+
+    def add(self, component: "PhysicsComponent") -> int:
+        if self.count == len(self.grounded):
+            for name in self.array_names:
+                array = getattr(self, name)
+                grown = np.zeros((len(array) * 2,) + array.shape[1:], dtype=array.dtype)
+                grown[: self.count] = array[: self.count]
+                setattr(self, name, grown)
+        index = self.count
+        for name in self.array_names:
+            getattr(self, name)[index] = 0
+        self.count += 1
+        return index
+
+    def remove_dead(self):
+        alive = np.array([component.alive for component in self.components], dtype=bool)
+        if alive.all():
+            return
+        for name in self.array_names:
+            array = getattr(self, name)
+            array[: np.count_nonzero(alive)] = array[: self.count][alive]
+        self.components = [c for c in self.components if c.alive]
+        self.count = len(self.components)
+        for index, component in enumerate(self.components):
+            component.index = index
 
     def update(self, world):
-        self.components = [i for i in self.components if i.update(world)]
+        self.remove_dead()
+        n = self.count
+        if n == 0:
+            return super().update()
+        dt = world.dt
+        owners = [component.owner for component in self.components]
+        pos, vel = self.pos[:n], self.vel[:n]
+        # game objects can get moved around outside of physics
+        pos[:] = [(o.pos.x, o.pos.y) for o in owners]
+        vel[:] = [(o.vel.x, o.vel.y) for o in owners]
+        force = self.force[:n]
+        force += world.gravity
+
+        # friction brings the x velocity to 0, a lot faster on the ground
+        friction = np.where(self.grounded[:n], 20.0, 1.0)
+        targets = [
+            (component.index, fx, target)
+            for component, fx, target in self.target_forces
+            if component.alive
+        ]
+        self.target_forces = []
+        bodies = np.array(
+            [row[0] for row in targets] + list(range(n)), dtype=int
+        )
+        target_forces = np.array(
+            [row[1] for row in targets] + (-np.copysign(friction, vel[:, 0])).tolist()
+        )
+        target_vels = np.array([row[2] for row in targets] + [0.0] * n)
+        np.add.at(
+            force[:, 0],
+            bodies,
+            self.target_force_x(vel[bodies, 0], target_forces, target_vels, dt),
+        )
+
+        self.push_apart(world)
+
+        vel += force * dt + self.impulse[:n]
+        self.last_force[:n] = force
+        force[:] = 0
+        self.impulse[:n] = 0
+
+        was_grounded = self.grounded[:n].copy()
+        self.move_y(world.tilemap, dt)
+        self.move_x(world.tilemap, dt)
+
+        grounded = self.grounded[:n]
+        for index in np.nonzero(grounded & ~was_grounded)[0].tolist():
+            if owners[index].tag == Tags.PLAYER:
+                world.events.post("player_grounded", owners[index], coalesce=True)
+
+        for owner, (x, y, vx, vy) in zip(
+            owners, np.concatenate([pos, vel], axis=1).tolist()
+        ):
+            owner.pos = pg.Vector2(x, y)
+            owner.vel = pg.Vector2(vx, vy)
+            owner.components[Collider].rect.center = (x, y)
         return super().update()
 
+    def target_force_x(
+        self, vel: np.ndarray, force: np.ndarray, target: np.ndarray, dt: float
+    ) -> np.ndarray:
+        """
+        The x force every target force ends up applying. A force pushes the
+        velocity towards its target but never past it, once the velocity would
+        overshoot it only gets the force that lands exactly on the target
+        """
+        new_vel = vel + force * dt
+        exact = (target - vel) / dt
+        pushing_up = force > 0
+        crossing = np.where(
+            pushing_up, (vel < target) & (new_vel > target), (vel > target) & (new_vel < target)
+        )
+        below = np.where(pushing_up, new_vel < target, new_vel > target)
+        applied = np.where(crossing, exact, np.where(below, force, 0.0))
+        return np.where((vel == target) | (force == 0), 0.0, applied)
+
+    def push_apart(self, world: "World"):
+        """
+        Bodies overlapping another collider get pushed away from its center,
+        when that collider's tags let it collide with the body. The pairs come
+        from the collider system's cells
+        """
+        n = self.count
+        bodies, dif = [], []
+        for index, component in enumerate(self.components):
+            collider = component.collider
+            # added since the collider system last updated, not in its cells yet
+            if collider.cell_range is None:
+                continue
+            x, y = collider.rect.center
+            for collision in world.cs.get_entity_collisions(collider):
+                cx, cy = collision.rect.center
+                bodies.append(index)
+                dif.append((x - cx, y - cy))
+        if not bodies:
+            return
+        dif = np.array(dif)
+        length = np.linalg.norm(dif, axis=1)
+        same = length == 0
+        # bodies exactly on top of each other go a random way
+        dif[same] = np.random.random((np.count_nonzero(same), 2))
+        length[same] = np.linalg.norm(dif[same], axis=1)
+        push = dif / length[:, None] * (80, 20)
+        np.add.at(self.force[:n], bodies, push)
+
+    def solid(self, tilemap, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        return Tiles.collidable[tilemap.get_ids(xs, ys)]
+
+    def corners(self, tilemap):
+        """
+        Which of the 4 tiles under the corners of every body are solid and
+        actually overlap it, as (top left, top right, bottom left, bottom right)
+        and the tile columns and rows
+        """
+        n = self.count
+        top_left = self.pos[:n] - self.size[:n] / 2
+        bottom_right = top_left + self.size[:n]
+        x1, y1 = np.floor(top_left).astype(int).T
+        x2, y2 = np.floor(bottom_right).astype(int).T
+        # a tile right at the right or bottom edge only touches the body
+        x2_in = bottom_right[:, 0] > x2
+        y2_in = bottom_right[:, 1] > y2
+        solid = self.solid(
+            tilemap, np.concatenate([x1, x2, x1, x2]), np.concatenate([y1, y1, y2, y2])
+        ).reshape(4, n)
+        return (
+            solid[0],
+            solid[1] & x2_in,
+            solid[2] & y2_in,
+            solid[3] & x2_in & y2_in,
+            (x1, x2, y1, y2),
+        )
+
+    def move_y(self, tilemap, dt: float):
+        n = self.count
+        pos, vel, half = self.pos[:n], self.vel[:n], self.size[:n, 1] / 2
+        pos[:, 1] += vel[:, 1] * dt
+        top_left, top_right, bottom_left, bottom_right, (_, _, y1, y2) = self.corners(tilemap)
+        top = top_left | top_right
+        bottom = bottom_left | bottom_right
+        falling = (vel[:, 1] > 0) & (top | bottom)
+        rising = (vel[:, 1] < 0) & (top | bottom)
+        # land on the tile under the body, or the one it's stuck in
+        pos[falling, 1] = np.where(bottom, y2, y1)[falling] - half[falling]
+        pos[rising, 1] = np.where(top, y1, y2)[rising] + 1 + half[rising]
+        vel[falling | rising, 1] = 0
+        self.grounded[:n] = falling
+
+    def move_x(self, tilemap, dt: float):
+        n = self.count
+        pos, vel, half = self.pos[:n], self.vel[:n], self.size[:n, 0] / 2
+        pos[:, 0] += vel[:, 0] * dt
+        top_left, top_right, bottom_left, bottom_right, (x1, x2, _, _) = self.corners(tilemap)
+        left = top_left | bottom_left
+        right = top_right | bottom_right
+        moving_right = (vel[:, 0] > 0) & (left | right)
+        moving_left = (vel[:, 0] < 0) & (left | right)
+        pos[moving_right, 0] = np.where(right, x2, x1)[moving_right] - half[moving_right]
+        pos[moving_left, 0] = np.where(left, x1, x2)[moving_left] + 1 + half[moving_left]
+        vel[moving_right | moving_left, 0] = 0
+
 
 class PhysicsComponent(Component):
-    def __init__(self, owner, system: System) -> None:
-        super().__init__(owner, system)
+    """
+    View of one body of the PhysicsSystem
+    """
 
-        self.grounded = False
+    def __init__(self, owner, system: PhysicsSystem) -> None:
+        super().__init__(owner, system)
+        self.system = system
+        self.index = system.add(self)
+        self.collider: Collider = owner.components[Collider]
+        system.size[self.index] = self.collider.rect.size
         self.flying = False
-        self.gravity = pg.Vector2(0, 20)
-        self.forces: list[pg.Vector2] = []
-        self.target_forces: list[tuple(pg.Vector2, pg.Vector2)] = []
-        self.impulses: list[pg.Vector2] = []
-        self.last_forces: list[pg.Vector2] = []
 
+    @property
+    def grounded(self) -> bool:
+        return bool(self.system.grounded[self.index])
+
+    @grounded.setter
+    def grounded(self, grounded: bool):
+        self.system.grounded[self.index] = grounded
+
+    @property
+    def last_forces(self) -> list[pg.Vector2]:
+        return [pg.Vector2(self.system.last_force[self.index].tolist())]
+
+    # dead components lose their row, their index can belong to another body by now
     def apply_force(self, vec: pg.Vector2):
-        self.forces.append(vec)
+        if self.alive:
+            self.system.force[self.index] += vec
 
     def apply_force_target(self, vec: pg.Vector2, target: pg.Vector2):
-        self.target_forces.append((vec, target))
+        """
+        Pushes the x velocity towards target.x with vec.x without overshooting it
+        """
+        if self.alive:
+            self.system.target_forces.append((self, vec.x, target.x))
 
     def apply_impulse(self, vec: pg.Vector2):
-        self.impulses.append(vec)
+        if self.alive:
+            self.system.impulse[self.index] += vec
 
     def debug_draw(self, world: "World"):
         center = (self.owner.pos - world.camera) * TILE_SIZE
@@ -64,103 +286,3 @@ class PhysicsComponent(Component):
             center,
             center + self.owner.vel * 4,
         )
-
-    def handle_force_target(self, game_object, force, target, dt) -> bool:
-        if game_object.vel.x == target.x:
-            return
-        new_vel = game_object.vel + force * dt
-
-        if force.x > 0:
-            if game_object.vel.x < target.x and new_vel.x > target.x:
-                dif = target.x - game_object.vel.x
-
-                self.apply_force(pg.Vector2(dif / dt, 0))
-
-            elif new_vel.x < target.x:
-                self.apply_force(force)
-        if force.x < 0:
-            if game_object.vel.x > target.x and new_vel.x < target.x:
-                dif = target.x - game_object.vel.x
-                self.apply_force(pg.Vector2(dif / dt, 0))
-            elif new_vel.x > target.x:
-                self.apply_force(force)
-
-    def apply_friction(self, game_object):
-        fric = 1
-        if self.grounded:
-            fric = 20
-
-        self.apply_force_target(
-            pg.Vector2(-(math.copysign(fric, game_object.vel.x)), 0), pg.Vector2(0, 0)
-        )
-
-    def push_away_from_collision(self, rect, collision):
-        c1 = pg.Vector2(rect.center)
-        c2 = pg.Vector2(collision.rect.center)
-        dif = c1 - c2
-
-        if dif != pg.Vector2(0, 0):
-            direction = dif.normalize()
-        else:
-            direction = pg.Vector2(random.random(), random.random()).normalize()
-        self.apply_force(direction.elementwise() * pg.Vector2(80, 20))
-
-    def update(self, world: "World"):
-        rect = self.owner.components[Collider].rect
-        dt = world.dt
-        self.gravity = world.gravity
-
-        self.apply_force(self.gravity)
-        self.apply_friction(self.owner)
-
-        if entity_collisions := world.cs.get_entity_collisions(
-            self.owner.components[Collider]
-        ):
-            for collision in entity_collisions:
-                self.push_away_from_collision(rect, collision)
-
-        for force, target in self.target_forces:
-            self.handle_force_target(self.owner, force, target, dt)
-
-        for force in self.forces:
-            self.owner.vel += force * dt
-        for impulse in self.impulses:
-            self.owner.vel += impulse
-
-        self.last_forces = self.forces
-        self.forces = []
-        self.impulses = []
-        self.target_forces = []
-
-        rect.y += self.owner.vel.y * dt
-        tile_collisions = world.tilemap.get_collisions(self.owner)
-        self.last_grounded = self.grounded
-        self.grounded = False
-
-        if tile_collisions:
-            for collision in tile_collisions:
-                if self.owner.vel.y > 0:
-                    self.owner.vel.y = 0
-                    self.grounded = True
-                    rect.bottom = collision.top
-                    if not self.last_grounded and self.owner.tag == Tags.PLAYER:
-                        post_event("player_grounded", self.owner)
-                if self.owner.vel.y < 0:
-                    self.owner.vel.y = 0
-                    rect.top = collision.bottom
-
-        rect.x += self.owner.vel.x * dt
-
-        tile_collisions = world.tilemap.get_collisions(self.owner)
-        if tile_collisions:
-            for collision in tile_collisions:
-                if self.owner.vel.x > 0:
-                    self.owner.vel.x = 0
-                    rect.right = collision.left
-
-                if self.owner.vel.x < 0:
-                    self.owner.vel.x = 0
-                    rect.left = collision.right
-
-        self.owner.pos = pg.Vector2(rect.center)
-        return super().update()
@@ -21,5 +21,7 @@ class SimpleRenderer(Component):
         self.size = pg.Vector2(self.image.get_size())
 
     def update(self, world: "World") -> bool:
-        world.draw_image(self.owner.pos - self.size / 2 / TILE_SIZE, self.image)
+        world.draw_image(
+            self.owner.render_pos(world.alpha) - self.size / 2 / TILE_SIZE, self.image
+        )
         return super().update()
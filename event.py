@@ -1,12 +1,96 @@
-subscribers = dict()
-
-def subscribe(event_type: str, fn):
-    if not event_type in subscribers:
-        subscribers[event_type] = []
-    subscribers[event_type].append(fn)
-
-def post_event(event_type: str, data):
-    if not event_type in subscribers:
-        return
-    for fn in subscribers[event_type]:
-        fn(data)
\ No newline at end of file
+import weakref
+from typing import Any, Callable
+
+
+class EventBus:
+    """
+    Events posted with post wait until dispatch, which the world calls once
+    per simulation step, posting with post_now calls the handlers right away.
+
+    A handler subscribed with batch=True gets called once with the list of
+    everything posted since the last dispatch instead of once per event.
+    Posting with coalesce=True drops the event if the same object was
+    already posted as that type this step, like player_grounded for the
+    same player.
+
+    weak=True only keeps a weak reference to the handler (a WeakMethod for
+    bound methods), it unsubscribes itself once the handler is gone
+    """
+
+    def __init__(self):
+        # event type -> [(handler or weakref to it, weak, batch)]
+        self.subscribers: dict[str, list[tuple[Any, bool, bool]]] = {}
+        # event type -> payloads waiting for dispatch
+        self.pending: dict[str, list] = {}
+        # event type -> ids of the coalesced payloads in pending
+        self.coalesced: dict[str, set[int]] = {}
+
+    def subscribe(
+        self, event_type: str, fn: Callable, batch: bool = False, weak: bool = False
+    ) -> Callable:
+        if weak:
+            ref = weakref.WeakMethod(fn) if hasattr(fn, "__self__") else weakref.ref(fn)
+            entry = (ref, True, batch)
+        else:
+            entry = (fn, False, batch)
+        self.subscribers.setdefault(event_type, []).append(entry)
+        return fn
+
+    def unsubscribe(self, event_type: str, fn: Callable):
+        self.subscribers[event_type] = [
+            entry
+            for entry in self.subscribers.get(event_type, [])
+            if (entry[0]() if entry[1] else entry[0]) != fn
+        ]
+
+    def handlers(self, event_type: str) -> list[tuple[Callable, bool]]:
+        """
+        (handler, batch) of the live handlers, drops the dead weak ones
+        """
+        entries = self.subscribers.get(event_type)
+        if not entries:
+            return []
+        handlers = []
+        dead = False
+        for fn, weak, batch in entries:
+            if weak:
+                fn = fn()
+                if fn is None:
+                    dead = True
+                    continue
+            handlers.append((fn, batch))
+        if dead:
+            self.subscribers[event_type] = [
+                entry for entry in entries if not entry[1] or entry[0]() is not None
+            ]
+        return handlers
+
+    def post(self, event_type: str, data, coalesce: bool = False):
+        if event_type not in self.subscribers:
+            return
+        if coalesce:
+            seen = self.coalesced.setdefault(event_type, set())
+            if id(data) in seen:
+                return
+            seen.add(id(data))
+        self.pending.setdefault(event_type, []).append(data)
+
+    def post_now(self, event_type: str, data):
+        for fn, batch in self.handlers(event_type):
+            fn([data] if batch else data)
+
+    def dispatch(self):
+        """
+        Hands out everything posted since the last dispatch, events posted by
+        the handlers wait for the next one
+        """
+        pending = self.pending
+        self.pending = {}
+        self.coalesced = {}
+        for event_type, payloads in pending.items():
+            for fn, batch in self.handlers(event_type):
+                if batch:
+                    fn(payloads)
+                else:
+                    for data in payloads:
+                        fn(data)
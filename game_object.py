@@ -6,8 +6,11 @@ class GameObject:
     def __init__(self, x: float, y: float, w: float = 0.0, h: float = 0.0, tag: Tags = Tags.DEFAULT):
         self.vel = pg.Vector2(0, 0)
         self.pos = pg.Vector2(x, y)
+        # pos before the last simulation step, None until the first one
+        self.prev_pos = None
         self.tag = tag
         self.components = {}
+        self.alive = True
     
     def add_component(self, component):
         self.components[type(component)] = component
@@ -16,6 +19,15 @@ class GameObject:
     def update(self, world: "World"):
         pass
 
+    def render_pos(self, alpha: float) -> pg.Vector2:
+        """
+        Position alpha of the way from the previous simulation step to the current one
+        """
+        if self.prev_pos is None:
+            return self.pos
+        return self.prev_pos.lerp(self.pos, alpha)
+
     def kill(self):
+        self.alive = False
         for i in self.components.values():
             i.kill()
\ No newline at end of file
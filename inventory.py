@@ -1,18 +1,39 @@
 import pygame as pg
 import pygame.freetype as ft
 from settings import *
-from typing import Optional
+from bisect import insort
+from typing import Callable, Optional
 from item import Item
 
+# (font id, stack size) -> rendered text, see count_glyphs
+glyph_cache: dict[tuple[int, int], pg.Surface] = {}
+
+
+def count_glyphs(font: ft.Font, count: int) -> pg.Surface:
+    key = (id(font), count)
+    if (glyphs := glyph_cache.get(key)) is None:
+        glyphs = glyph_cache[key] = font.render(str(count), (255, 255, 255))[0]
+    return glyphs
+
 
 class ItemStack:
     def __init__(self, item_data: Optional["Item"] = None, stack_size: int = -1):
         self.item_data = item_data
         self.stack_size = stack_size
+        # called with the stack whenever it changes, like InventoryUI redrawing its slot
+        self.watchers: list[Callable[["ItemStack"], None]] = []
+
+    def watch(self, fn: Callable[["ItemStack"], None]):
+        self.watchers.append(fn)
+
+    def changed(self):
+        for fn in self.watchers:
+            fn(self)
 
     def clear(self):
         self.item_data = None
         self.stack_size = -1
+        self.changed()
 
     @property
     def is_empty(self) -> bool:
@@ -29,56 +50,193 @@ class ItemStack:
             if new_stack_size > self.item_data.max_stack:
                 other.remove(self.item_data.max_stack - self.stack_size)
                 self.stack_size = self.item_data.max_stack
+                self.changed()
             else:
                 self.stack_size += other.stack_size
+                self.changed()
                 other.clear()
 
     def remove(self, amount: int):
         self.stack_size -= amount
         if self.stack_size <= 0:
             self.clear()
+        else:
+            self.changed()
 
     def set_data(self, item_data: Optional[Item], stack_size: int) -> None:
         self.item_data = item_data
         self.stack_size = stack_size
+        self.changed()
 
     def draw(self, font: ft.Font, x: float, y: float, surf: pg.Surface):
         if self.item_data is None:
             return
         surf.blit(self.item_data.img, (x, y))
         if self.stack_size > 1:
-            font.render_to(surf, (x, y), str(self.stack_size), (255, 255, 255))
+            surf.blit(count_glyphs(font, self.stack_size), (x, y))
 
     def right_click(self, world, component):
         if self.is_empty:
             return
         self.item_data.right_click(world, component, self)
 class Inventory:
+    """
+    Slots are the ItemStacks in items, the inventory watches them so its
+    index stays right however they get changed (the UI moves stacks around
+    directly). The index has the slots holding every item, which of them
+    aren't full yet, the empty slots and the total count of every item, so
+    adding an item only looks at its unfilled stacks and then takes empty
+    slots in order.
+
+    add_many, remove_many and transfer take {item: amount}, remove_many and
+    transfer either do all of it or nothing
+    """
+
     def __init__(self, size: int):
         self.size = size
         self.items = [ItemStack() for _ in range(size)]
+        # item -> sorted slots holding it, and the ones of them that aren't full
+        self.slots: dict[Item, list[int]] = {}
+        self.partial: dict[Item, list[int]] = {}
+        # sorted empty slots
+        self.free: list[int] = list(range(size))
+        # item -> total amount
+        self.counts: dict[Item, int] = {}
+        # slot -> (item, amount) the index has for it
+        self.seen: list[tuple[Optional[Item], int]] = [(None, 0)] * size
+        for i, item_stack in enumerate(self.items):
+            item_stack.watch(lambda _, i=i: self.slot_changed(i))
+
+    def slot_changed(self, i: int):
+        self.unindex(i, *self.seen[i])
+        item_stack = self.items[i]
+        self.seen[i] = (item_stack.item_data, max(item_stack.stack_size, 0))
+        self.index(i, *self.seen[i])
+
+    def index(self, i: int, item: Optional[Item], amount: int):
+        if item is None:
+            insort(self.free, i)
+            return
+        insort(self.slots.setdefault(item, []), i)
+        if amount < item.max_stack:
+            insort(self.partial.setdefault(item, []), i)
+        self.counts[item] = self.counts.get(item, 0) + amount
+
+    def unindex(self, i: int, item: Optional[Item], amount: int):
+        if item is None:
+            self.free.remove(i)
+            return
+        for slot_index in (self.slots, self.partial):
+            if i in (slots := slot_index.get(item, ())):
+                slots.remove(i)
+                if not slots:
+                    del slot_index[item]
+        self.counts[item] -= amount
+        if not self.counts[item]:
+            del self.counts[item]
+
+    def count(self, item_data: Item) -> int:
+        return self.counts.get(item_data, 0)
+
+    def room(self, item_data: Item) -> int:
+        """
+        How much of item_data fits in the slots already holding it
+        """
+        return sum(
+            item_data.max_stack - self.items[i].stack_size
+            for i in self.partial.get(item_data, ())
+        )
+
+    def fits(self, items: dict[Item, int]) -> bool:
+        """
+        Whether add_many would take all of items
+        """
+        needed_slots = 0
+        for item_data, amount in items.items():
+            overflow = amount - self.room(item_data)
+            if overflow > 0:
+                needed_slots += -(-overflow // item_data.max_stack)
+        return needed_slots <= len(self.free)
+
+    def add(self, item_data: Item, stack_size: int) -> int:
+        """
+        Fills up the stacks of item_data first, then empty slots. Returns
+        what didn't fit
+        """
+        for i in list(self.partial.get(item_data, ())):
+            if stack_size <= 0:
+                return 0
+            item_stack = self.items[i]
+            taken = min(item_data.max_stack - item_stack.stack_size, stack_size)
+            item_stack.set_data(item_data, item_stack.stack_size + taken)
+            stack_size -= taken
+        while stack_size > 0 and self.free:
+            taken = min(item_data.max_stack, stack_size)
+            self.items[self.free[0]].set_data(item_data, taken)
+            stack_size -= taken
+        return max(stack_size, 0)
+
+    def add_many(self, items: dict[Item, int]) -> dict[Item, int]:
+        """
+        Adds every item, returns the amounts that didn't fit
+        """
+        left = {}
+        for item_data, amount in items.items():
+            if amount > 0 and (rest := self.add(item_data, amount)):
+                left[item_data] = rest
+        return left
 
-    def add(self, item_data: "Item", stack_size: int):
-        add_item_stack = ItemStack(item_data, stack_size)
-        for item_stack in self.items:
-            item_stack.combine(add_item_stack)
-            if add_item_stack.is_empty:
-                break
+    def remove(self, item_data: Item, amount: int) -> bool:
+        return self.remove_many({item_data: amount})
+
+    def remove_many(self, items: dict[Item, int]) -> bool:
+        """
+        Takes all of items out, emptying the last slots first. If some item
+        is short nothing gets removed and it returns False
+        """
+        if any(self.count(item_data) < amount for item_data, amount in items.items()):
+            return False
+        for item_data, amount in items.items():
+            for i in reversed(list(self.slots.get(item_data, ()))):
+                if amount <= 0:
+                    break
+                item_stack = self.items[i]
+                taken = min(item_stack.stack_size, amount)
+                item_stack.remove(taken)
+                amount -= taken
+        return True
+
+    def transfer(self, other: "Inventory", items: dict[Item, int]) -> bool:
+        """
+        Moves items into other, only if all of them are here and fit there
+        """
+        if not other.fits(items):
+            return False
+        if not self.remove_many(items):
+            return False
+        other.add_many(items)
+        return True
 
 
 class InventoryUI:
+    """
+    Keeps its panel drawn on self.surface. Stacks changing or the selection
+    moving mark their slots dirty, draw only redraws those before the one
+    blit of the panel
+    """
+
     def __init__(self, item_stacks: list[ItemStack], width: int, height: int):
         self.items = item_stacks
         self.width = width
         self.height = height
-        self.selected_index = -1
+        self._selected_index = -1
 
         self.cell_margin = 4
         self.cell_padding = 2
         self.cell_total = self.cell_margin + self.cell_padding + TILE_SIZE
 
         self.rect_padding = 4
-        self.font = font
+        self.font = get_font()
         self.rect = pg.Rect(
             0,
             0,
@@ -89,6 +247,29 @@ class InventoryUI:
         self.rect.center = (WIDTH // 2, HEIGHT // 2)
         self.item_rects = self.generate_rects()
         self.surface = pg.Surface(self.rect.size)
+        self.surface.fill("#181425")
+        pg.draw.rect(self.surface, "#262b44", ((0, 0), self.rect.size), width=1)
+
+        cell_size = self.item_rects[0].size
+        self.cell = pg.Surface(cell_size)
+        self.cell.fill("#262b44")
+        self.selected_cell = self.cell.copy()
+        pg.draw.rect(self.selected_cell, "#feae34", ((0, 0), cell_size), width=1)
+
+        self.dirty = set(range(len(self.items)))
+        for i, item_stack in enumerate(self.items):
+            item_stack.watch(lambda _, i=i: self.dirty.add(i))
+
+    @property
+    def selected_index(self) -> int:
+        return self._selected_index
+
+    @selected_index.setter
+    def selected_index(self, index: int):
+        self.dirty.update(
+            i for i in (self._selected_index, index) if 0 <= i < len(self.items)
+        )
+        self._selected_index = index
 
     def generate_rects(self) -> list[pg.FRect]:
         item_rects: list[pg.FRect] = []
@@ -127,21 +308,25 @@ class InventoryUI:
         else:
             itemstack.combine(mouse_item_stack)
 
-    def draw(self, surf: pg.Surface):
-        self.surface.fill("#181425")
-        pg.draw.rect(self.surface, "#262b44", ((0, 0), self.rect.size), width=1)
-        for i, rect in enumerate(self.item_rects):
-            pg.draw.rect(self.surface, "#262b44", rect)
-            if self.selected_index == i:
-                pg.draw.rect(self.surface, "#feae34", rect, width=1)
-            item_stack = self.items[i]
-            item_stack.draw(
-                self.font,
-                rect.x + self.cell_padding // 2,
-                rect.y + self.cell_padding // 2,
-                self.surface,
-            )
+    def draw_slot(self, i: int):
+        rect = self.item_rects[i]
+        cell = self.selected_cell if self.selected_index == i else self.cell
+        self.surface.blit(cell, rect)
+        # big stack counts don't spill into the next cell
+        self.surface.set_clip(rect)
+        self.items[i].draw(
+            self.font,
+            rect.x + self.cell_padding // 2,
+            rect.y + self.cell_padding // 2,
+            self.surface,
+        )
+        self.surface.set_clip(None)
 
+    def draw(self, surf: pg.Surface):
+        if self.dirty:
+            for i in self.dirty:
+                self.draw_slot(i)
+            self.dirty.clear()
         surf.blit(self.surface, self.rect)
 
 class UIBar:
@@ -150,14 +335,19 @@ class UIBar:
         self.value = value
         self.rect = rect
         self.surface = pg.Surface(self.rect.size)
+        # width of the filled part on self.surface, only redrawn when it changes
+        self.drawn_width = None
         
     def draw(self, surf: pg.Surface):
-        self.surface.fill("#181425")
+        width = int((self.rect.size[0] - 6) * min(self.value / self.max_value, 1))
+        if width != self.drawn_width:
+            self.drawn_width = width
+            self.surface.fill("#181425")
 
-        pg.draw.rect(self.surface, "#262b44", ((0, 0), self.rect.size), width=1)
-        pg.draw.rect(self.surface, "#262b44", ((3, 3), ((self.rect.size[0] - 6), self.rect.size[1] - 6)))
+            pg.draw.rect(self.surface, "#262b44", ((0, 0), self.rect.size), width=1)
+            pg.draw.rect(self.surface, "#262b44", ((3, 3), ((self.rect.size[0] - 6), self.rect.size[1] - 6)))
 
-        pg.draw.rect(self.surface, "#c0cbdc", ((3, 3), ((self.rect.size[0] - 6) * (self.value/ self.max_value), self.rect.size[1] - 6)))
+            pg.draw.rect(self.surface, "#c0cbdc", ((3, 3), (width, self.rect.size[1] - 6)))
         surf.blit(self.surface, self.rect)
     def handle_event(self, *args):
         pass
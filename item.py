@@ -1,6 +1,5 @@
-from tools import load_img
+from assets import assets
 
-from functools import cached_property
 class Item:
     def __init__(self, img_path : str, name : str, max_stack : int=64):
         self.img_path = img_path
@@ -9,10 +8,9 @@ class Item:
 
 
 
-    @cached_property
+    @property
     def img(self):
-        #only load the image when its needed
-        #also prevents an error where the image tries to load before pg.set_mode has been called
-        return load_img(self.img_path)
+        # the atlas subsurface once main preloaded the textures, see Assets
+        return assets.texture(self.img_path)
 
 
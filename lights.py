@@ -1,72 +1,366 @@
 import pygame as pg
-from settings import TILE_SIZE, WIDTH, HEIGHT
-from event import subscribe, post_event
-from typing import Optional
+import numpy as np
+from collections import OrderedDict
+from settings import TILE_SIZE, WIDTH, HEIGHT, LIGHT_ATLAS_BYTES, LIGHT_RADIUS_STEP, MAX_LIGHT_RADIUS, LIGHT_SCALE
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from world import World
+    from game_object import GameObject
+
 
 class Light:
-    img_cache = {}
-    def __init__(self, radius: int, pos: pg.Vector2, color: tuple[int, int, int], parent : Optional["GameObject"] = None):
-        self.radius = radius
-        self.pos = pos
-        self.color = color
-        post_event("light_added", self)
-        self.alive = True
-        self.parent = parent
+    """
+    Handle to a slot of a LightManager. The slot can get reused once the light
+    is killed, the generation makes sure an old handle can't touch the new light
+    """
+
+    atlas: "LightAtlas"
+    __slots__ = ("manager", "slot", "generation")
+
+    def __init__(self, manager: "LightManager", slot: int, generation: int):
+        self.manager = manager
+        self.slot = slot
+        self.generation = generation
+
+    @property
+    def alive(self) -> bool:
+        return self.manager.generations[self.slot] == self.generation
 
     def kill(self):
-        post_event("light_killed", self)
+        self.manager.remove(self)
+
+    @property
+    def pos(self) -> pg.Vector2:
+        return pg.Vector2(self.manager.pos[self.slot].tolist())
+
+    @pos.setter
+    def pos(self, pos):
+        self.manager.pos[self.slot] = pos
+
+    @property
+    def radius(self) -> int:
+        return int(self.manager.radius[self.slot])
+
+    @radius.setter
+    def radius(self, radius: int):
+        self.manager.radius[self.slot] = radius
+
+    @property
+    def color(self) -> tuple[int, int, int]:
+        return tuple(self.manager.color[self.slot].tolist())
 
-    def update(self, world):
-        if self.parent:
-            self.pos = self.parent.pos
+    @color.setter
+    def color(self, color: tuple[int, int, int]):
+        self.manager.color[self.slot] = color
 
     @property
     def img(self):
-        key = (self.radius, self.color)
-        if img := self.img_cache.get(key, None):
-            pass
+        return self.atlas.get(self.atlas.quantize(self.radius), self.color)
+
+    @classmethod
+    def sprite(cls, radius: int, color: tuple[int, int, int]) -> pg.Surface:
+        return cls.atlas.get(cls.atlas.quantize(radius), color)
+
+
+def falloff_curve() -> np.ndarray:
+    # brightness of every ring from the edge (0) inwards, like the circles
+    # the old sprites were drawn with
+    lights = [255]
+    for i in range(1, 255):
+        val = lights[i - 1] - i * 0.1
+        if val < 0:
+            break
+        lights.append(val)
+    return 255 - np.array(lights)
+
+
+class LightAtlas:
+    """
+    Light sprites for a fixed set of radii. Every radius gets one greyscale
+    falloff texture, tinted copies of it are kept in an LRU cache limited to
+    max_bytes. Radii get rounded up to the next step so shrinking lights
+    don't make a new sprite every frame
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = LIGHT_ATLAS_BYTES,
+        step: float = LIGHT_RADIUS_STEP,
+        max_radius: int = MAX_LIGHT_RADIUS,
+    ):
+        self.max_bytes = max_bytes
+        radii = [1]
+        while radii[-1] < max_radius:
+            radii.append(max(radii[-1] + 1, round(radii[-1] * step)))
+        self.radii = np.array(radii)
+        self.curve = falloff_curve()
+        # (radius, color) -> sprite, color None is the greyscale texture
+        self.sprites: OrderedDict[tuple, pg.Surface] = OrderedDict()
+        self.bytes = 0
+
+    def quantize(self, radius):
+        """
+        The step radius is drawn with, works on single radii and arrays
+        """
+        index = np.searchsorted(self.radii, radius).clip(0, len(self.radii) - 1)
+        return self.radii[index] if np.ndim(radius) else int(self.radii[index])
+
+    def falloff(self, radius: int) -> pg.Surface:
+        # distance of every pixel centre from the middle, in radii
+        coords = (np.arange(radius * 2) + 0.5 - radius) / radius
+        dist = np.hypot(coords[:, None], coords[None, :])
+        ring = np.floor(len(self.curve) * (1 - dist)).astype(int)
+        grey = np.where(dist <= 1, self.curve[ring.clip(0, len(self.curve) - 1)], 0)
+        return pg.surfarray.make_surface(
+            np.repeat(grey[:, :, None], 3, axis=2).astype(np.uint8)
+        )
+
+    def get(self, radius: int, color: Optional[tuple[int, int, int]]) -> pg.Surface:
+        """
+        Sprite for an already quantized radius
+        """
+        key = (radius, color)
+        if (img := self.sprites.get(key)) is not None:
+            self.sprites.move_to_end(key)
+            return img
+        if color is None:
+            img = self.falloff(radius)
         else:
-            lights = [255]
-            img = pg.Surface((self.radius*2, self.radius*2))
-            for i in range(1, 255):
-                val = lights[i - 1] - i * 0.1
-                if val < 0:
-                    break
-                lights.append(val)
-
-            n = len(lights)
-            for i in range(n):
-                val = (255 - lights[i]) / 255
-                pg.draw.circle(img, (val * self.color[0], val * self.color[1], val * self.color[2]), (self.radius, self.radius), (n - i) / n * self.radius)
-            self.img_cache[key] = img
+            img = self.get(radius, None).copy()
+            img.fill(color, special_flags=pg.BLEND_MULT)
+        self.sprites[key] = img
+        self.bytes += img.get_width() * img.get_height() * img.get_bytesize()
+        self.evict(keep=key)
         return img
 
+    def evict(self, keep: tuple):
+        while self.bytes > self.max_bytes and len(self.sprites) > 1:
+            key, img = next(iter(self.sprites.items()))
+            if key == keep:
+                break
+            del self.sprites[key]
+            self.bytes -= img.get_width() * img.get_height() * img.get_bytesize()
+
+    def warmup(self, colors: list[tuple[int, int, int]], max_radius: int):
+        """
+        Builds the sprites of every step up to max_radius in colors ahead of time
+        """
+        for radius in self.radii[self.radii <= max_radius].tolist():
+            for color in colors:
+                self.get(radius, tuple(color))
+
+    def blits(
+        self,
+        radii: np.ndarray,
+        colors: np.ndarray,
+        centers: np.ndarray,
+        size: tuple[int, int] = (WIDTH, HEIGHT),
+    ) -> list[tuple[pg.Surface, list[float]]]:
+        """
+        (sprite, top left) blits for lights with centers on a surface of size,
+        skipping the ones that don't touch it
+        """
+        visible = radii > 0
+        radii = self.quantize(radii)
+        visible &= (
+            (centers[:, 0] > -radii)
+            & (centers[:, 0] < size[0] + radii)
+            & (centers[:, 1] > -radii)
+            & (centers[:, 1] < size[1] + radii)
+        )
+        radii = radii[visible]
+        colors = colors[visible].astype(np.int64)
+        # one lookup per distinct sprite instead of one per light
+        keys, inverse = np.unique(
+            (radii << 24) | (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2],
+            return_inverse=True,
+        )
+        sprites = [
+            self.get(key >> 24, ((key >> 16) & 255, (key >> 8) & 255, key & 255))
+            for key in keys.tolist()
+        ]
+        return list(
+            zip(
+                map(sprites.__getitem__, inverse.tolist()),
+                (centers[visible] - radii[:, None]).tolist(),
+            )
+        )
+
+
+Light.atlas = LightAtlas()
+
+
 class LightManager:
-    def __init__(self) -> None:
-        self.lights: list[Light] = []
-        self.light_surf = pg.Surface((WIDTH, HEIGHT))
-        subscribe("light_added", self.add)
-        subscribe("light_killed", self.remove)
+    """
+    Lights live in slots of parallel numpy arrays. Killed slots go on a free
+    list and get handed out again, so adding and removing a light doesn't
+    depend on how many there are. A light can have an owner, it follows the
+    owner around and dies with it.
+
+    Lights are drawn onto a lightmap scale times smaller than the screen,
+    which gets smoothly scaled up and multiplied onto the screen
+    """
+
+    array_names = ("pos", "radius", "color", "active", "generations")
+
+    def __init__(self, capacity: int = 64, scale: int = LIGHT_SCALE) -> None:
+        self.pos = np.zeros((capacity, 2))
+        self.radius = np.zeros(capacity, dtype=int)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.generations = np.zeros(capacity, dtype=np.int64)
+        # slots below size have been used at some point, free ones are in free
+        self.size = 0
+        self.free: list[int] = []
+        # slot -> GameObject of the lights that have an owner
+        self.owners: dict[int, "GameObject"] = {}
+        # things that draw their own batch of lights, like the ParticleManager
+        self.sources = []
+        self.set_scale(scale)
+
+    def set_scale(self, scale: int):
+        """
+        1 draws the lights at full resolution, 2 at half and so on
+        """
+        self.scale = scale
+        self.light_surf = pg.Surface((WIDTH // scale, HEIGHT // scale))
+        self.screen_light_surf = (
+            self.light_surf if scale == 1 else pg.Surface((WIDTH, HEIGHT))
+        )
+
+    def __len__(self) -> int:
+        return self.size - len(self.free)
 
-    def add(self, light: Light):
-        self.lights.append(light)
+    def reserve(self, capacity: int):
+        if capacity <= len(self.active):
+            return
+        capacity = max(capacity, len(self.active) * 2)
+        for name in self.array_names:
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self.size] = array[: self.size]
+            setattr(self, name, grown)
+
+    def take_slots(self, n: int) -> np.ndarray:
+        reused = self.free[len(self.free) - min(n, len(self.free)) :]
+        del self.free[len(self.free) - len(reused) :]
+        new = n - len(reused)
+        self.reserve(self.size + new)
+        slots = np.concatenate(
+            [np.array(reused, dtype=int), np.arange(self.size, self.size + new)]
+        )
+        self.size += new
+        return slots
+
+    def add(
+        self,
+        radius: int,
+        pos,
+        color: tuple[int, int, int],
+        owner: Optional["GameObject"] = None,
+    ) -> Light:
+        if self.free:
+            slot = self.free.pop()
+        else:
+            self.reserve(self.size + 1)
+            slot = self.size
+            self.size += 1
+        self.pos[slot] = pos
+        self.radius[slot] = radius
+        self.color[slot] = color
+        self.active[slot] = True
+        if owner is not None:
+            self.owners[slot] = owner
+        return Light(self, slot, int(self.generations[slot]))
+
+    def add_many(self, n: int, radius, pos, color) -> list[Light]:
+        """
+        Adds n lights at once for emitters, every argument is either one value
+        for all of them or an array with one row per light
+        """
+        if n <= 0:
+            return []
+        slots = self.take_slots(n)
+        self.pos[slots] = np.broadcast_to(np.asarray(pos, dtype=float), (n, 2))
+        self.radius[slots] = radius
+        self.color[slots] = np.broadcast_to(np.asarray(color), (n, 3))
+        self.active[slots] = True
+        return [
+            Light(self, slot, generation)
+            for slot, generation in zip(
+                slots.tolist(), self.generations[slots].tolist()
+            )
+        ]
 
     def remove(self, light: Light):
-        self.lights.remove(light)    
+        if not light.alive:
+            return
+        self.free_slot(light.slot)
 
-    def draw(self, world: "World", debug: bool = False):
-        self.light_surf.fill((5, 5, 5))
-        draw_list = []
+    def remove_many(self, lights: list[Light]):
+        for light in lights:
+            self.remove(light)
+
+    def free_slot(self, slot: int):
+        self.active[slot] = False
+        self.generations[slot] += 1
+        self.owners.pop(slot, None)
+        self.free.append(slot)
 
-        for l in self.lights:
-            l.update(world)
-            draw_list.append((l.img, (l.pos - world.camera) * TILE_SIZE - pg.Vector2(l.radius)))
+    def add_source(self, source):
+        """
+        source.lights(world) gets called every frame and returns the radii,
+        colors and screen centers of its lights as arrays
+        """
+        self.sources.append(source)
 
+    def remove_dead(self):
+        """
+        Frees the lights whose owner died, once per simulation step so headless
+        worlds that never draw don't keep them around
+        """
+        for slot in [slot for slot, owner in self.owners.items() if not owner.alive]:
+            self.free_slot(slot)
 
-        self.light_surf.fblits(
-            draw_list, pg.BLEND_MAX
+    def update_owners(self, alpha: float = 1):
+        if self.owners:
+            self.pos[list(self.owners)] = [
+                tuple(owner.render_pos(alpha)) for owner in self.owners.values()
+            ]
+
+    def lights(self, world: "World") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        slots = np.nonzero(self.active[: self.size])[0]
+        return (
+            self.radius[slots],
+            self.color[slots],
+            (self.pos[slots] - np.asarray(world.camera)) * TILE_SIZE,
+        )
+
+    def draw(self, world: "World", debug: bool = False):
+        self.update_owners(world.alpha)
+        radii, colors, centers = zip(
+            self.lights(world), *(source.lights(world) for source in self.sources)
+        )
+        radii = np.concatenate(radii)
+        if self.scale != 1:
+            # lights smaller than a lightmap pixel drop out
+            radii = np.round(radii / self.scale).astype(int)
+        draw_list = Light.atlas.blits(
+            radii,
+            np.concatenate(colors),
+            np.concatenate(centers) / self.scale,
+            self.light_surf.get_size(),
         )
+
+        # tiles lit by the sky and emissive tiles are the base of the lightmap
+        world.tilemap.draw_light(self.light_surf, world.camera, self.scale)
+        self.light_surf.fblits(draw_list, pg.BLEND_MAX)
+        if self.scale != 1:
+            pg.transform.smoothscale(
+                self.light_surf, (WIDTH, HEIGHT), self.screen_light_surf
+            )
         if debug:
-            world.surf.blit(self.light_surf, (0, 0))
+            world.surf.blit(self.screen_light_surf, (0, 0))
         else:
-            world.surf.blit(self.light_surf, (0, 0), special_flags=pg.BLEND_MULT)
+            world.surf.blit(self.screen_light_surf, (0, 0), special_flags=pg.BLEND_MULT)
@@ -1,14 +1,10 @@
 import enum
 import pygame as pg
 
-pg.mixer.init()
-pg.display.init()
-
 from settings import *
 
-win = pg.display.set_mode((WIDTH, HEIGHT), FLAGS)
-print(win)
 from world import World
+from assets import assets
 from inventory import ItemStack, InventoryUI, UIBar
 from components.input import PlayerInputComponent
 
@@ -18,10 +14,41 @@ class State(enum.Enum):
     GAME = 1
 
 
+def loading_screen(win: pg.Surface, font, clock: pg.Clock):
+    """
+    Shows a progress bar while assets decodes the textures and sounds
+    """
+    assets.start()
+    bar = pg.Rect(0, 0, WIDTH // 2, 6)
+    bar.center = (WIDTH // 2, HEIGHT // 2)
+    while not assets.ready:
+        pg.event.pump()
+        win.fill((0, 0, 0))
+        font.render_to(win, (bar.x, bar.y - 12), "loading", (255, 255, 255))
+        pg.draw.rect(win, (255, 255, 255), bar, 1)
+        filled = bar.inflate(-4, -4)
+        filled.w = int(filled.w * assets.progress())
+        pg.draw.rect(win, (255, 255, 255), filled)
+        pg.display.flip()
+        clock.tick(60)
+    assets.build_atlas()
+    print(
+        f"assets loaded, time:{assets.load_time:.2f}s, "
+        f"atlas:{assets.atlas.get_size()} {assets.atlas_bytes() // 1024}KiB"
+    )
+
+
 def main():
+    # not at import time, worldgen workers re-import this module on spawn based platforms
+    pg.mixer.init()
+    pg.display.init()
+    win = pg.display.set_mode((WIDTH, HEIGHT), FLAGS)
+    font = get_font()
+    print(win)
     state = State.GAME
     clock = pg.Clock()
-    world = World(win)
+    loading_screen(win, font, clock)
+    world = World(win, SAVE_PATH)
 
     inventory = InventoryUI(world.player.inventory.items[: 9 * 4], 9, 4)
     hotbar = InventoryUI(world.player.inventory.items[-9:], 9, 1)
@@ -48,12 +75,13 @@ def main():
             lines.append(f"player.vel=[{player.vel.x:.2f}, {player.vel.y:.2f}]")
             lines.append(f"player.break_time={player.input_component.break_timer:.2f}")
             lines.append(f"mouse_tile={world.get_mouse_tile_pos()}")
-            lines.append(f"paritcles={len(world.pm.particles)}")
-            lines.append(f"lights={len(world.lm.lights)}")
+            lines.append(f"paritcles={len(world.pm)}")
+            lines.append(f"lights={len(world.lm)}")
+            lines.append(f"atlas={assets.atlas_bytes() // 1024}KiB misses={assets.misses}")
 
         except Exception as ex:
             lines.append(str(ex))
-        bg = pg.Surface((170, 80), pg.SRCALPHA)
+        bg = pg.Surface((170, 82), pg.SRCALPHA)
         bg.fill((0, 0, 0, 125))
         win.blit(bg, (0, 0))
         y = 1
@@ -61,15 +89,14 @@ def main():
         for line in lines:
             font.render_to(win, (1, y), line, (255, 255, 255))
             y += 10
+        world.profiler.draw(win, font, (0, 84))
 
     while True:
         dt = clock.tick() / 1000
-        # throttle dt
-        dt = min(dt, 0.2)
 
         world.player.equipped_stack = hotbar.items[hotbar.selected_index]
         if state == State.GAME:
-            world.update(dt)
+            world.frame(dt)
             hotbar.draw(win)
             uibar.draw(win)
             uibar.value = world.player.components[PlayerInputComponent].dash_timer.time
@@ -87,6 +114,7 @@ def main():
 
         for event in pg.event.get():
             if event.type == pg.QUIT:
+                world.save()
                 raise SystemExit
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_ESCAPE:
@@ -98,6 +126,10 @@ def main():
                 if event.key == pg.K_TAB:
                     debug_on = not debug_on
                     world.debug_on = debug_on
+                if event.key == pg.K_F3:
+                    # open in chrome://tracing or ui.perfetto.dev
+                    world.profiler.export_trace("trace.json")
+                    print("wrote trace.json")
 
                 if event.unicode != "" and event.unicode in "123456789":
                     hotbar.selected_index = int(event.unicode) - 1
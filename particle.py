@@ -1,80 +1,132 @@
 import pygame as pg
+import numpy as np
 from typing import TYPE_CHECKING, Dict
-from customtypes import ColorValue
-from settings import TILE_SIZE
-from lights import Light
+from settings import TILE_SIZE, WIDTH, HEIGHT
 
 if TYPE_CHECKING:
     from world import World
 
 
 class ParticleManager:
-    def __init__(self) -> None:
-        self.particles: list[Particle] = []
-
-    def update(self, world):
-        self.particles = [
-            particle for particle in self.particles if particle.update(world)
-        ]
-
-    def add(self, particles):
-        self.particles.extend(particles)
-
-    def draw(self, world: "World"):
-        world.surf.fblits(
-            [(p.img, (p.pos - world.camera) * TILE_SIZE) for p in self.particles]
-        )
-
-
-
-
-class Particle:
-    img_cache: Dict[tuple[int, ColorValue], pg.Surface] = {}
-
-    def __init__(
+    """
+    Particles stored as parallel numpy arrays, the first `count` rows are alive.
+    Every particle is a square that shrinks over its lifetime and lights up
+    its surroundings, see lights
+    """
+
+    img_cache: Dict[tuple[int, int, int, int], pg.Surface] = {}
+    array_names = ("pos", "vel", "accel", "time", "life_time", "start_size", "color")
+
+    def __init__(self, capacity: int = 256) -> None:
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.accel = np.zeros((capacity, 2))
+        self.time = np.zeros(capacity)
+        self.life_time = np.zeros(capacity)
+        self.start_size = np.zeros(capacity)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def arrays(self) -> list[np.ndarray]:
+        return [getattr(self, name) for name in self.array_names]
+
+    def reserve(self, capacity: int):
+        if capacity <= len(self.time):
+            return
+        capacity = max(capacity, len(self.time) * 2)
+        for name in self.array_names:
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self.count] = array[: self.count]
+            setattr(self, name, grown)
+
+    def emit(
         self,
-        life_time: float,
-        pos: pg.Vector2,
-        vel: pg.Vector2,
-        size: int,
-        color: tuple,
-        accel: pg.Vector2 = pg.Vector2(0, 0)
+        n: int,
+        pos,
+        vel,
+        life_time,
+        size,
+        color,
+        accel=(0, 0),
     ):
-        self.pos = pos
-        self.vel = vel
-        self.time = 0
-        self.life_time = life_time
-        self.size = size
-        self.start_size = size
-        self.color = color
-        self.accel = accel
-        self.light = Light(self.size * 6, self.pos, self.color, self)
+        """
+        Spawns n particles. Every argument is either one value for all of them
+        or an array with one row per particle, colors are rgb tuples
+        """
+        if n <= 0:
+            return
+        self.reserve(self.count + n)
+        new = slice(self.count, self.count + n)
+        self.pos[new] = np.broadcast_to(np.asarray(pos, dtype=float), (n, 2))
+        self.vel[new] = np.broadcast_to(np.asarray(vel, dtype=float), (n, 2))
+        self.accel[new] = np.broadcast_to(np.asarray(accel, dtype=float), (n, 2))
+        self.time[new] = 0
+        self.life_time[new] = life_time
+        self.start_size[new] = size
+        self.color[new] = np.broadcast_to(np.asarray(color), (n, 3))
+        self.count += n
 
     def update(self, world: "World"):
-        self.pos += self.vel * world.dt
-
-        self.vel += self.accel * world.dt
-        self.time += world.dt
-
-        if self.time >= self.life_time:
-            self.light.kill()
-            return 0
-        frac = 1 - self.time/ self.life_time
-        self.size = int(self.start_size * frac +1)
-        self.light.radius = int(self.start_size * frac * 6)
-        return 1
-
-
-    @property 
-    def img(self):
-        key = (self.size, self.color)
-        if img := self.img_cache.get(key, None):
-            pass
-        else:
-            img = pg.Surface((self.size, self.size))
-            img.fill(self.color)
-            self.img_cache[key] = img
-        return img
-
-
+        n = self.count
+        if n == 0:
+            return
+        dt = world.dt
+        self.pos[:n] += self.vel[:n] * dt
+        self.vel[:n] += self.accel[:n] * dt
+        self.time[:n] += dt
+
+        alive = self.time[:n] < self.life_time[:n]
+        alive_count = int(np.count_nonzero(alive))
+        if alive_count < n:
+            # move the living particles to the front
+            for array in self.arrays:
+                array[:alive_count] = array[:n][alive]
+            self.count = alive_count
+
+    def fraction_left(self) -> np.ndarray:
+        return 1 - self.time[: self.count] / self.life_time[: self.count]
+
+    def on_screen(self, screen_pos: np.ndarray, margin: np.ndarray) -> np.ndarray:
+        return (
+            (screen_pos[:, 0] > -margin)
+            & (screen_pos[:, 0] < WIDTH + margin)
+            & (screen_pos[:, 1] > -margin)
+            & (screen_pos[:, 1] < HEIGHT + margin)
+        )
 
+    def draw(self, world: "World"):
+        if self.count == 0:
+            return
+        sizes = (self.start_size[: self.count] * self.fraction_left() + 1).astype(int)
+        screen_pos = (self.pos[: self.count] - np.asarray(world.camera)) * TILE_SIZE
+        visible = self.on_screen(screen_pos, sizes)
+
+        img_cache = self.img_cache
+        draw_list = []
+        for size, (r, g, b), screen in zip(
+            sizes[visible].tolist(),
+            self.color[: self.count][visible].tolist(),
+            screen_pos[visible].tolist(),
+        ):
+            key = (size, r, g, b)
+            if (img := img_cache.get(key)) is None:
+                img = pg.Surface((size, size))
+                img.fill((r, g, b))
+                img_cache[key] = img
+            draw_list.append((img, screen))
+        world.surf.fblits(draw_list)
+
+    def lights(self, world: "World") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Lights for LightManager, every particle glows with 6 times its size
+        """
+        return (
+            (self.start_size[: self.count] * self.fraction_left() * 6).astype(int),
+            self.color[: self.count],
+            (self.pos[: self.count] - np.asarray(world.camera)) * TILE_SIZE,
+        )
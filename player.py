@@ -2,15 +2,14 @@ import pygame as pg
 from settings import TILE_SIZE, Tags
 from tiles import Tiles as t
 from inventory import Inventory
-from tools import load_img, Timer, get_img_dimensions
+from tools import Timer, get_img_dimensions
+from assets import assets
 import abc
 import math
 from typing import TYPE_CHECKING, Any, Optional
 from customtypes import Coordinate
 import random
 
-from lights import Light
-
 if TYPE_CHECKING:
     from world import World
     from inventory import ItemStack
@@ -49,7 +48,8 @@ class Player2(GameObject):
         self.health = self.max_health
         self.inventory.items[0].set_data(t.DIRT, 999)
 
-        self.add_component(PlayerInputComponent(self, world.ins))
+        if not world.headless:
+            self.add_component(PlayerInputComponent(self, world.ins))
 
     def update(self, world: "World"):
         return 1
@@ -66,7 +66,7 @@ class Enemy1(GameObject):
         self.add_component(PhysicsComponent(self, world.ps))
         self.add_component(SimpleRenderer(self, world.rs, self.image))
 
-        self.light = Light(50, self.pos, color, self)
+        self.light = world.lm.add(50, self.pos, color, self)
 
     def update(self, world: "World"):
         return 0
@@ -77,9 +77,9 @@ class TileOverlay(GameObject):
     def __init__(self, x, y):
         super().__init__(x, y)
         self.breaking_sprites = [
-            load_img(f"textures/breaking/{i}.png") for i in range(1, 5)
+            assets.texture(f"textures/breaking/{i}.png") for i in range(1, 5)
         ]
-        self.select_sprite = load_img("textures/select.png")
+        self.select_sprite = assets.texture("textures/select.png")
 
     def update(self, world: "World"):
         pass
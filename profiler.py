@@ -0,0 +1,162 @@
+import json
+import time
+import pygame as pg
+import numpy as np
+import pygame.freetype as ft
+from collections import deque
+from contextlib import contextmanager
+from settings import SIM_RATE
+
+STAGE_COLORS = [
+    (228, 59, 68),
+    (254, 174, 52),
+    (99, 199, 77),
+    (44, 232, 245),
+    (0, 149, 233),
+    (181, 80, 136),
+    (246, 117, 122),
+    (254, 231, 97),
+    (139, 155, 180),
+    (38, 92, 66),
+]
+
+
+class Profiler:
+    """
+    Times nested stages of every frame. Stages are keyed by their path like
+    "draw/lights", the time a stage takes in a frame goes into a ring buffer
+    holding the last `frames` frames. Every stage run is also kept (up to
+    max_events) for exporting as a Chrome trace, open it in chrome://tracing
+    or ui.perfetto.dev
+    """
+
+    def __init__(self, frames: int = 300, max_events: int = 50000):
+        self.frames = frames
+        self.enabled = True
+        # stage key -> seconds per frame, indexed by frame % frames
+        self.history: dict[str, np.ndarray] = {}
+        # stage key -> seconds so far this frame
+        self.current: dict[str, float] = {}
+        # stages that had stages inside them, the bar only shows the innermost ones
+        self.parents: set[str] = set()
+        self.stack: list[str] = []
+        self.frame_count = 0
+        self.frame_times = np.zeros(frames)
+        self.frame_start = time.perf_counter()
+        self.origin = self.frame_start
+        # (stage key, start, duration) in seconds since origin
+        self.events: deque[tuple[str, float, float]] = deque(maxlen=max_events)
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        if self.stack:
+            self.parents.add(self.stack[-1])
+            key = self.stack[-1] + "/" + name
+        else:
+            key = name
+        self.stack.append(key)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.stack.pop()
+            self.current[key] = self.current.get(key, 0) + duration
+            self.events.append((key, start - self.origin, duration))
+
+    def end_frame(self):
+        """
+        Moves this frame's stage times into the ring buffers, the frame is
+        everything since the last end_frame
+        """
+        now = time.perf_counter()
+        index = self.frame_count % self.frames
+        for key in self.current:
+            if key not in self.history:
+                self.history[key] = np.zeros(self.frames)
+        for key, times in self.history.items():
+            times[index] = self.current.get(key, 0)
+        self.frame_times[index] = now - self.frame_start
+        self.events.append(("frame", self.frame_start - self.origin, now - self.frame_start))
+        self.current = {}
+        self.frame_start = now
+        self.frame_count += 1
+
+    def recorded(self, times: np.ndarray) -> np.ndarray:
+        return times[: min(self.frame_count, self.frames)]
+
+    def percentiles(self, key: str) -> tuple[float, float]:
+        """
+        p50 and p99 of a stage (or "frame") in seconds
+        """
+        times = self.recorded(self.frame_times if key == "frame" else self.history[key])
+        if len(times) == 0:
+            return 0.0, 0.0
+        p50, p99 = np.percentile(times, [50, 99])
+        return float(p50), float(p99)
+
+    def leaves(self) -> list[str]:
+        return [key for key in self.history if key not in self.parents]
+
+    def export_trace(self, path: str):
+        """
+        Writes the recorded stages as Chrome trace event JSON
+        """
+        trace_events = [
+            {
+                "name": key.rpartition("/")[2],
+                "cat": key.rpartition("/")[0] or "frame",
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": 0,
+                "tid": 0,
+                "args": {"stage": key},
+            }
+            for key, start, duration in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def draw(self, surf: pg.Surface, font: ft.Font, pos, width: int = 200):
+        """
+        Stacked bar of the p50 of every innermost stage, with the frame budget
+        marked, and a p50/p99 line per stage underneath
+        """
+        x, y = pos
+        leaves = self.leaves()
+        line_height = 10
+        height = 26 + line_height * len(leaves)
+        bg = pg.Surface((width, height), pg.SRCALPHA)
+        bg.fill((0, 0, 0, 125))
+        surf.blit(bg, (x, y))
+
+        # the bar is two frame budgets wide
+        budget = 1 / SIM_RATE
+        px_per_second = (width - 4) / (budget * 2)
+        bar_x = x + 2
+        for i, key in enumerate(leaves):
+            p50 = self.percentiles(key)[0]
+            w = p50 * px_per_second
+            pg.draw.rect(surf, STAGE_COLORS[i % len(STAGE_COLORS)], (bar_x, y + 2, w, 10))
+            bar_x += w
+        budget_x = x + 2 + budget * px_per_second
+        pg.draw.line(surf, (255, 255, 255), (budget_x, y + 1), (budget_x, y + 12))
+
+        p50, p99 = self.percentiles("frame")
+        font.render_to(
+            surf, (x + 2, y + 14), f"frame p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms", (255, 255, 255)
+        )
+        for i, key in enumerate(leaves):
+            p50, p99 = self.percentiles(key)
+            line_y = y + 24 + i * line_height
+            pg.draw.rect(surf, STAGE_COLORS[i % len(STAGE_COLORS)], (x + 2, line_y + 1, 6, 6))
+            font.render_to(
+                surf,
+                (x + 11, line_y),
+                f"{key} {p50 * 1000:.2f} / {p99 * 1000:.2f}ms",
+                (255, 255, 255),
+            )
@@ -2,9 +2,7 @@ import pygame as pg
 from components.collider import Collider
 from components.render import SimpleRenderer
 from tools import hexstr2tuple
-from event import post_event
 from game_object import GameObject
-from lights import Light
 from settings import TILE_SIZE, Tags
 import random
 
@@ -20,7 +18,7 @@ class Projectile(GameObject):
             hexstr2tuple("#b55088"),
             hexstr2tuple("#f6757a"),
         ][random.randint(0, 2)]
-        self.light = Light(img.get_size()[0] * 8, self.pos, self.color)
+        self.light = world.lm.add(img.get_size()[0] * 8, self.pos, self.color, self)
         img.fill(self.color)
         self.add_component(SimpleRenderer(self, world.rs, img))
 
@@ -28,11 +26,9 @@ class Projectile(GameObject):
         dt = world.dt
         self.pos += self.vel * dt
         self.vel += world.gravity * world.dt
-        self.light.pos = self.pos
         cols = world.tilemap.get_collisions(self)
         if cols:
-            post_event("projectile_explosion", self)
-            self.light.kill()
+            world.events.post("projectile_explosion", self)
             self.kill()
             return 0
         return 1
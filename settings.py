@@ -1,7 +1,7 @@
 import pygame as pg
 import pygame.freetype as ft
 import enum
-ft.init()
+import functools
 
 TILE_SIZE = 16
 HEIGHT = 360
@@ -9,10 +9,61 @@ WIDTH = HEIGHT//9 * 14
 
 FLAGS = pg.SCALED | pg.RESIZABLE
 #FLAGS = pg.SCALED | pg.RESIZABLE | pg.FULLSCREEN
-font = ft.Font("textures/scientifica/ttf/scientifica.ttf", 11)
+
+
+@functools.cache
+def get_font() -> ft.Font:
+    # loaded on first use, headless worlds never need it
+    ft.init()
+    return ft.Font("textures/scientifica/ttf/scientifica.ttf", 11)
+
 
 class Tags(enum.Enum):
     DEFAULT = enum.auto()
     PLAYER = enum.auto()
     PROJECTILE = enum.auto()
-    ENEMY = enum.auto()
\ No newline at end of file
+    ENEMY = enum.auto()
+# tilemap rendering, chunks are CHUNK_SIZE x CHUNK_SIZE tiles
+CHUNK_SIZE = 32
+MAX_CACHED_CHUNKS = 24
+
+# streamed worlds (see StreamingTilemap), chunks are GEN_CHUNK_WIDTH columns wide
+STREAM_WORLD = False
+MAX_LOADED_CHUNKS = 16
+# chunks this many tiles around the camera and entities stay loaded
+STREAM_DISTANCE = 64
+
+# world saves (see WorldFile), None to never save or load
+SAVE_PATH = "saves/world.s2d"
+AUTOSAVE_INTERVAL = 60
+
+# light sprites (see LightAtlas), radii get rounded up to one of a fixed set of sizes
+LIGHT_ATLAS_BYTES = 16 * 1024 * 1024
+LIGHT_RADIUS_STEP = 1.1
+MAX_LIGHT_RADIUS = 512
+# lights are drawn at 1 / LIGHT_SCALE of the screen resolution and scaled up,
+# 1 is full quality, 2 half and 4 quarter
+LIGHT_SCALE = 2
+
+# tile light (see TileLight), levels go from 0 to MAX_TILE_LIGHT and drop by 1 every tile
+MAX_TILE_LIGHT = 15
+# color of a tile at full sky light, and of the darkest caves
+SKY_LIGHT_COLOR = (110, 110, 130)
+AMBIENT_LIGHT = (5, 5, 5)
+
+# the simulation runs in fixed steps of 1 / SIM_RATE seconds, rendering in between
+# gets interpolated. A slow frame runs at most MAX_SIM_STEPS steps, the rest of
+# its time is dropped so the game slows down instead of spiralling
+SIM_RATE = 60
+MAX_SIM_STEPS = 5
+
+# water (see WaterSim), flows one tile per tick. Only blocks of WATER_BLOCK x WATER_BLOCK
+# tiles where water moved or tiles changed get simulated, settled water sleeps
+WATER_TICK = 0.05
+WATER_BLOCK = 16
+
+# neighbor updates and scheduled tile ticks handled per simulation step (see TileUpdates)
+TILE_UPDATE_BUDGET = 256
+
+# tiles within this many tiles of a projectile explosion get destroyed
+EXPLOSION_RADIUS = 2.5
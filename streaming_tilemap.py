@@ -0,0 +1,337 @@
+import os
+import random
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from math import floor
+from typing import Optional, TYPE_CHECKING
+from settings import WIDTH, TILE_SIZE, MAX_LOADED_CHUNKS, STREAM_DISTANCE
+from tilemap import Tilemap
+from world_gen import GEN_CHUNK_WIDTH, generate_chunk, chunk_trees, tree_cells
+from world_file import WorldFile, ChunkData
+
+if TYPE_CHECKING:
+    from world import World
+
+
+class StreamingTilemap(Tilemap):
+    """
+    Tilemap without a horizontal limit. Columns live in GEN_CHUNK_WIDTH wide
+    chunks that are generated (or read back from the world file) the first time
+    anything touches them. Once more than max_chunks are loaded the least
+    recently used chunks that aren't near the camera or an entity get unloaded,
+    modified ones are written to the world file and the rest are dropped since
+    they generate the same again. Without a world file a temporary one is used
+    """
+
+    def __init__(
+        self,
+        height: int,
+        seed: Optional[int] = None,
+        max_chunks: int = MAX_LOADED_CHUNKS,
+        world_file: Optional[WorldFile] = None,
+        load_distance: int = STREAM_DISTANCE,
+    ):
+        super().__init__(0, height)
+        self.width = None
+        self.grid = None
+        self.light_grid = None
+        self.water_grid = None
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.max_chunks = max_chunks
+        self.load_distance = load_distance
+        if world_file is None:
+            world_file = WorldFile.create(
+                os.path.join(tempfile.mkdtemp(prefix="sandbox2d_"), "stream.s2d"),
+                None,
+                height,
+                GEN_CHUNK_WIDTH,
+                self.seed,
+            )
+        self.world_file = world_file
+
+        # chunk index -> (height, GEN_CHUNK_WIDTH) tile ids, least recently used first
+        self.chunks: OrderedDict[int, np.ndarray] = OrderedDict()
+        # chunk index -> light levels of the loaded chunks, see TileLight
+        self.light_chunks: dict[int, np.ndarray] = {}
+        # chunk index -> water levels of the loaded chunks, see WaterSim
+        self.water_chunks: dict[int, np.ndarray] = {}
+
+    def get_chunk(self, chunk_index: int) -> np.ndarray:
+        chunk = self.chunks.get(chunk_index)
+        if chunk is None:
+            return self.load_chunk(chunk_index)
+        self.chunks.move_to_end(chunk_index)
+        return chunk
+
+    def load_chunk(self, chunk_index: int) -> np.ndarray:
+        data = self.world_file.read_chunk(chunk_index)
+        if data is None:
+            chunk = self.generate_chunk(chunk_index)
+        else:
+            chunk, water = data
+        self.chunks[chunk_index] = chunk
+        self.light_chunks[chunk_index] = np.zeros(chunk.shape, dtype=np.uint8)
+        self.water_chunks[chunk_index] = np.zeros(chunk.shape, dtype=np.float32)
+        if data is not None:
+            self.restore_water(water)
+        self.tile_light.invalidate(
+            chunk_index * GEN_CHUNK_WIDTH, (chunk_index + 1) * GEN_CHUNK_WIDTH
+        )
+        return chunk
+
+    def load_columns(self, x0: int, x1: int):
+        """
+        Makes sure the chunks of columns [x0, x1) are loaded, there's no edge
+        so it doesn't clip like Tilemap.load_columns
+        """
+        first, last = floor(x0 / GEN_CHUNK_WIDTH), floor((x1 - 1) / GEN_CHUNK_WIDTH)
+        for chunk_index in range(first, last + 1):
+            self.get_chunk(chunk_index)
+
+    def generate_chunk(self, chunk_index: int) -> np.ndarray:
+        chunk, trees = generate_chunk(
+            self.seed, chunk_index, GEN_CHUNK_WIDTH, self.height
+        )
+        # trees of the neighbouring chunks can hang over into this one
+        xs, ys, ids = tree_cells(
+            np.concatenate(
+                [
+                    chunk_trees(self.seed, chunk_index - 1, GEN_CHUNK_WIDTH, self.height),
+                    trees,
+                    chunk_trees(self.seed, chunk_index + 1, GEN_CHUNK_WIDTH, self.height),
+                ]
+            )
+        )
+        xs = xs - chunk_index * GEN_CHUNK_WIDTH
+        inside = (xs >= 0) & (xs < GEN_CHUNK_WIDTH) & (ys >= 0) & (ys < self.height)
+        xs, ys, ids = xs[inside], ys[inside], ids[inside]
+        empty = chunk[ys, xs] == 0
+        chunk[ys[empty], xs[empty]] = ids[empty]
+        return chunk
+
+    def unload_chunk(self, chunk_index: int):
+        if chunk_index in self.modified:
+            self.world_file.write({chunk_index: self.chunk_data(chunk_index)})
+            self.modified.discard(chunk_index)
+        del self.chunks[chunk_index]
+        del self.light_chunks[chunk_index]
+        del self.water_chunks[chunk_index]
+
+        # the water is in the world file now (or didn't change since it was read),
+        # it wakes up again when the chunk gets loaded
+        x0 = chunk_index * GEN_CHUNK_WIDTH
+        self.water_sim.forget(x0, x0 + GEN_CHUNK_WIDTH)
+
+    def all_chunks(self) -> list[int]:
+        return sorted(self.chunks.keys() | set(self.world_file.chunk_indices()))
+
+    def chunk_data(
+        self, chunk_index: int, old_file: Optional[WorldFile] = None
+    ) -> ChunkData:
+        # saving to a new file copies the unloaded chunks over without loading them
+        if chunk_index not in self.chunks and old_file is not None:
+            return old_file.read_chunk(chunk_index)
+        return self.get_chunk(chunk_index).copy(), self.chunk_water(chunk_index)
+
+    def restore_water(self, water: np.ndarray):
+        xs, ys = water[:, 0].astype(int), water[:, 1].astype(int)
+        chunk_indices, local_xs = np.divmod(xs, GEN_CHUNK_WIDTH)
+        for chunk_index in np.unique(chunk_indices).tolist():
+            selected = chunk_indices == chunk_index
+            self.water_chunks[chunk_index][ys[selected], local_xs[selected]] = water[selected, 2]
+        self.water_sim.wake_cells(xs, ys)
+
+    @classmethod
+    def from_file(cls, world_file: WorldFile) -> "StreamingTilemap":
+        return cls(world_file.height, world_file.seed, world_file=world_file)
+
+    def stream(self, world: "World"):
+        """
+        Loads the chunks around the camera and entities, then unloads the least
+        recently used other chunks until there are at most max_chunks
+        """
+        needed = set()
+        left = world.camera.x - self.load_distance
+        right = world.camera.x + WIDTH / TILE_SIZE + self.load_distance
+        needed.update(
+            range(floor(left / GEN_CHUNK_WIDTH), floor(right / GEN_CHUNK_WIDTH) + 1)
+        )
+        for game_object in world.layer0 + world.projectiles:
+            x = game_object.pos.x
+            needed.update(
+                range(
+                    floor((x - self.load_distance) / GEN_CHUNK_WIDTH),
+                    floor((x + self.load_distance) / GEN_CHUNK_WIDTH) + 1,
+                )
+            )
+
+        for chunk_index in needed:
+            self.get_chunk(chunk_index)
+
+        for chunk_index in list(self.chunks):
+            if len(self.chunks) <= self.max_chunks:
+                break
+            if chunk_index not in needed:
+                self.unload_chunk(chunk_index)
+
+    def update(self, world: "World"):
+        self.stream(world)
+        super().update(world)
+
+    def is_inside(self, pos) -> bool:
+        return 0 <= pos[1] < self.height
+
+    def clamp(self, pos) -> tuple[int, int]:
+        return floor(pos[0]), min(max(int(pos[1]), 0), self.height - 1)
+
+    def get_id(self, x: int, y: int) -> int:
+        chunk_index, local_x = divmod(x, GEN_CHUNK_WIDTH)
+        return self.get_chunk(chunk_index).item(y, local_x)
+
+    def set_id(self, x: int, y: int, tile_id: int):
+        chunk_index, local_x = divmod(x, GEN_CHUNK_WIDTH)
+        self.get_chunk(chunk_index)[y, local_x] = tile_id
+        self.modified.add(chunk_index)
+
+    def get_ids(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        ys = ys.clip(0, self.height - 1)
+        chunk_indices, local_xs = np.divmod(xs, GEN_CHUNK_WIDTH)
+        ids = np.zeros(len(xs), dtype=np.uint16)
+        for chunk_index in np.unique(chunk_indices).tolist():
+            selected = chunk_indices == chunk_index
+            ids[selected] = self.get_chunk(chunk_index)[ys[selected], local_xs[selected]]
+        return ids
+
+    def region_slices(self, x: int, y: int, w: int, h: int) -> tuple[slice, slice]:
+        return (
+            slice(min(max(y, 0), self.height), min(max(y + h, 0), self.height)),
+            slice(x, x + max(w, 0)),
+        )
+
+    def region_chunks(self, cols: slice):
+        """
+        (chunk index, map column slice, chunk column slice) of every chunk cols covers
+        """
+        for chunk_index in range(
+            cols.start // GEN_CHUNK_WIDTH, (cols.stop - 1) // GEN_CHUNK_WIDTH + 1
+        ):
+            x0 = chunk_index * GEN_CHUNK_WIDTH
+            start = max(cols.start, x0)
+            stop = min(cols.stop, x0 + GEN_CHUNK_WIDTH)
+            yield chunk_index, slice(start, stop), slice(start - x0, stop - x0)
+
+    def get_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """
+        Tile ids inside the rect, a view when the rect is inside one chunk and a copy otherwise
+        """
+        rows, cols = self.region_slices(x, y, w, h)
+        parts = [
+            self.get_chunk(chunk_index)[rows, local]
+            for chunk_index, _, local in self.region_chunks(cols)
+        ]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros((rows.stop - rows.start, 0), dtype=np.uint16)
+        return np.concatenate(parts, axis=1)
+
+    def set_region(self, pos, ids: np.ndarray, replace: bool = True):
+        x, y = floor(pos[0]), floor(pos[1])
+        h, w = ids.shape
+        rows, cols = self.region_slices(x, y, w, h)
+        ids = ids[rows.start - y : rows.stop - y]
+        for chunk_index, world_cols, local in self.region_chunks(cols):
+            self.write_region(
+                self.get_chunk(chunk_index)[rows, local],
+                ids[:, world_cols.start - x : world_cols.stop - x],
+                world_cols.start,
+                rows.start,
+                replace,
+            )
+            self.modified.add(chunk_index)
+        self.chunk_cache.invalidate_rect(x, rows.start, w, rows.stop - rows.start)
+        self.tile_light.invalidate(cols.start, cols.stop)
+        self.water_sim.wake(x, rows.start, w, rows.stop - rows.start)
+        self.tile_updates.notify_rect(x, rows.start, w, rows.stop - rows.start)
+
+    def set_cells(
+        self, xs: np.ndarray, ys: np.ndarray, ids: np.ndarray, replace: bool = True
+    ):
+        inside = (ys >= 0) & (ys < self.height)
+        xs, ys, ids = xs[inside], ys[inside], ids[inside]
+        chunk_indices = xs // GEN_CHUNK_WIDTH
+        for chunk_index in np.unique(chunk_indices).tolist():
+            selected = chunk_indices == chunk_index
+            written_xs, written_ys = self.write_cells(
+                self.get_chunk(chunk_index),
+                xs[selected],
+                ys[selected],
+                ids[selected],
+                chunk_index * GEN_CHUNK_WIDTH,
+                replace,
+            )
+            self.modified.add(chunk_index)
+            self.chunk_cache.invalidate_cells(written_xs, written_ys)
+            self.water_sim.wake_cells(written_xs, written_ys)
+            self.tile_updates.notify_cells(written_xs, written_ys)
+            if len(written_xs):
+                self.tile_light.invalidate(
+                    int(written_xs.min()), int(written_xs.max()) + 1
+                )
+
+    def read_layer(
+        self, layer: dict[int, np.ndarray], dtype, x: int, y: int, w: int, h: int
+    ) -> np.ndarray:
+        """
+        Copy of the rect of a per chunk layer like light_chunks, 0 outside the
+        map and in chunks that aren't loaded. Never loads chunks
+        """
+        values = np.zeros((h, w), dtype=dtype)
+        rows, cols = self.region_slices(x, y, w, h)
+        for chunk_index, world_cols, local in self.region_chunks(cols):
+            if (chunk := layer.get(chunk_index)) is not None:
+                values[
+                    rows.start - y : rows.stop - y,
+                    world_cols.start - x : world_cols.stop - x,
+                ] = chunk[rows, local]
+        return values
+
+    def write_layer(self, layer: dict[int, np.ndarray], x: int, y: int, values: np.ndarray):
+        h, w = values.shape
+        rows, cols = self.region_slices(x, y, w, h)
+        for chunk_index, world_cols, local in self.region_chunks(cols):
+            if (chunk := layer.get(chunk_index)) is not None:
+                chunk[rows, local] = values[
+                    rows.start - y : rows.stop - y,
+                    world_cols.start - x : world_cols.stop - x,
+                ]
+
+    def get_light_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        return self.read_layer(self.light_chunks, np.uint8, x, y, w, h)
+
+    def set_light_region(self, x: int, y: int, levels: np.ndarray):
+        self.write_layer(self.light_chunks, x, y, levels)
+
+    def get_water_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        return self.read_layer(self.water_chunks, np.float32, x, y, w, h)
+
+    def set_water_region(self, x: int, y: int, levels: np.ndarray):
+        self.write_layer(self.water_chunks, x, y, levels)
+
+    def loaded_columns(self, xs: np.ndarray) -> np.ndarray:
+        return np.isin(xs // GEN_CHUNK_WIDTH, list(self.chunks))
+
+    def loaded_spans(self, x0: int, x1: int) -> list[tuple[int, int]]:
+        """
+        The loaded parts of columns [x0, x1), relighting and water never load chunks
+        """
+        spans = []
+        for chunk_index, world_cols, _ in self.region_chunks(slice(x0, x1)):
+            if chunk_index not in self.chunks:
+                continue
+            if spans and spans[-1][1] == world_cols.start:
+                spans[-1] = (spans[-1][0], world_cols.stop)
+            else:
+                spans.append((world_cols.start, world_cols.stop))
+        return spans
@@ -0,0 +1,201 @@
+import pygame as pg
+import numpy as np
+from math import floor
+from settings import TILE_SIZE, MAX_TILE_LIGHT, SKY_LIGHT_COLOR, AMBIENT_LIGHT
+from tiles import Tiles
+from chunk_cache import ChunkCache
+from world_gen import GEN_CHUNK_WIDTH
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tilemap import Tilemap
+
+
+def propagate(
+    sources: np.ndarray, attenuation: np.ndarray, left: np.ndarray, right: np.ndarray
+) -> np.ndarray:
+    """
+    Flood fills light levels, every cell gets the brightest of its own source
+    and what its neighbours pass on, which is their level minus their
+    attenuation. So solid tiles still get lit, they just don't let light
+    through. left and right are what the columns next to the strip pass on,
+    above and below it is dark
+    """
+    h, w = sources.shape
+    passed = np.zeros((h + 2, w + 2), dtype=np.int16)
+    passed[1:-1, 0] = left
+    passed[1:-1, -1] = right
+    levels = sources
+    # light can't travel further than MAX_TILE_LIGHT tiles
+    for _ in range(MAX_TILE_LIGHT):
+        passed[1:-1, 1:-1] = levels - attenuation
+        brightest = np.maximum(
+            np.maximum(passed[:-2, 1:-1], passed[2:, 1:-1]),
+            np.maximum(passed[1:-1, :-2], passed[1:-1, 2:]),
+        )
+        new = np.maximum(sources, brightest)
+        if np.array_equal(new, levels):
+            break
+        levels = new
+    return levels.clip(0, MAX_TILE_LIGHT).astype(np.uint8)
+
+
+class TileLight:
+    """
+    Light level of every tile, from 0 to MAX_TILE_LIGHT. Sky light shines
+    straight down until tiles swallow it (see Tile.light_opacity), emissive
+    tiles glow with their light_emission, and from there light spreads out
+    losing 1 level per tile.
+
+    Changed columns get queued with invalidate and relit in update. A change
+    can only reach MAX_TILE_LIGHT tiles to the side, so only that many columns
+    around it get recomputed and the rest of the map is left alone. Wide
+    ranges (like the whole map after generating it) get relit in strips of
+    strip_width columns, which keeps the flood fill arrays small
+    """
+
+    def __init__(self, tilemap: "Tilemap", strip_width: int = GEN_CHUNK_WIDTH):
+        self.tilemap = tilemap
+        self.strip_width = strip_width
+        # [start, stop) column ranges whose tiles changed
+        self.pending: list[tuple[int, int]] = []
+        self.chunk_cache = LightChunkCache(tilemap)
+
+    def invalidate(self, x0: int, x1: int):
+        if x1 > x0:
+            self.pending.append((x0, x1))
+
+    def update(self):
+        if not self.pending:
+            return
+        ranges = sorted(
+            (x0 - MAX_TILE_LIGHT, x1 + MAX_TILE_LIGHT) for x0, x1 in self.pending
+        )
+        self.pending = []
+        merged = [ranges[0]]
+        for x0, x1 in ranges[1:]:
+            if x0 <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], x1))
+            else:
+                merged.append((x0, x1))
+        for x0, x1 in merged:
+            for start, stop in self.tilemap.loaded_spans(x0, x1):
+                for strip in range(start, stop, self.strip_width):
+                    strip_stop = min(strip + self.strip_width, stop)
+                    # nothing further than MAX_TILE_LIGHT away can light the
+                    # strip, so that much around it is enough to get it right
+                    self.relight(
+                        max(strip - MAX_TILE_LIGHT, start),
+                        min(strip_stop + MAX_TILE_LIGHT, stop),
+                        strip,
+                        strip_stop,
+                    )
+
+    def relight(
+        self, x0: int, x1: int, keep_x0: Optional[int] = None, keep_x1: Optional[int] = None
+    ):
+        """
+        Recomputes columns [x0, x1) and stores [keep_x0, keep_x1) of them (all
+        by default), the columns next to them are kept as they are
+        """
+        tilemap = self.tilemap
+        height = tilemap.height
+        keep_x0 = x0 if keep_x0 is None else keep_x0
+        keep_x1 = x1 if keep_x1 is None else keep_x1
+        ids = tilemap.get_region(x0, 0, x1 - x0, height)
+        opacity = Tiles.light_opacity[ids]
+        # sky light comes down every column until the tiles above swallow it
+        sky = MAX_TILE_LIGHT - (np.cumsum(opacity, axis=0) - opacity)
+        sources = np.maximum(sky, Tiles.light_emission[ids])
+        levels = propagate(
+            sources, opacity + 1, self.passed_on(x0 - 1), self.passed_on(x1)
+        )[:, keep_x0 - x0 : keep_x1 - x0]
+
+        old = tilemap.get_light_region(keep_x0, 0, keep_x1 - keep_x0, height)
+        changed_rows, changed_cols = np.nonzero(levels != old)
+        if len(changed_rows) == 0:
+            return
+        tilemap.set_light_region(keep_x0, 0, levels)
+        y0, y1 = changed_rows.min(), changed_rows.max() + 1
+        cx0, cx1 = changed_cols.min(), changed_cols.max() + 1
+        self.chunk_cache.invalidate_rect(
+            keep_x0 + int(cx0), int(y0), int(cx1 - cx0), int(y1 - y0)
+        )
+
+    def passed_on(self, x: int) -> np.ndarray:
+        """
+        The light column x passes on to its neighbours
+        """
+        tilemap = self.tilemap
+        levels = tilemap.get_light_region(x, 0, 1, tilemap.height)[:, 0].astype(np.int16)
+        # unlit columns can be outside the map or in chunks that aren't loaded
+        if levels.any():
+            levels -= Tiles.light_opacity[tilemap.get_region(x, 0, 1, tilemap.height)[:, 0]] + 1
+        return levels
+
+    def draw(self, surf: pg.Surface, camera: pg.Vector2, scale: int = 1):
+        self.update()
+        self.chunk_cache.draw(surf, camera, scale)
+
+
+class LightChunkCache(ChunkCache):
+    """
+    The tile light as colors, one pixel per tile. Drawing scales the visible
+    tiles up smoothly onto a lightmap
+    """
+
+    def __init__(self, tilemap: "Tilemap", *args, **kwargs):
+        super().__init__(tilemap, *args, **kwargs)
+        # light level -> color
+        levels = np.arange(MAX_TILE_LIGHT + 1)[:, None] / MAX_TILE_LIGHT
+        self.colors = np.maximum(
+            np.array(SKY_LIGHT_COLOR) * levels, AMBIENT_LIGHT
+        ).astype(np.uint8)
+        self.view = None
+        self.scaled_view = None
+
+    def new_surface(self) -> pg.Surface:
+        return pg.Surface((self.chunk_size, self.chunk_size))
+
+    def render_chunk(self, key: tuple[int, int], surf: pg.Surface):
+        cs = self.chunk_size
+        levels = self.tilemap.get_light_region(key[0] * cs, key[1] * cs, cs, cs)
+        pg.surfarray.blit_array(surf, self.colors[levels.T])
+
+    def draw(self, surf: pg.Surface, camera: pg.Vector2 = pg.Vector2(0, 0), scale: int = 1):
+        """
+        Draws onto a surface scale times smaller than the screen, camera is the
+        map position of its top left corner
+        """
+        tile_size = TILE_SIZE / scale
+        w, h = surf.get_size()
+        tx, ty = floor(camera.x), floor(camera.y)
+        view_size = (int(w / tile_size) + 2, int(h / tile_size) + 2)
+        if self.view is None or self.view.get_size() != view_size:
+            self.view = pg.Surface(view_size)
+            self.scaled_view = pg.Surface(
+                (round(view_size[0] * tile_size), round(view_size[1] * tile_size))
+            )
+        # above the map is open sky
+        self.view.fill(self.colors[-1])
+
+        cs = self.chunk_size
+        cx_start, cx_end = tx // cs, (tx + view_size[0] - 1) // cs
+        if self.tilemap.width is not None:
+            cx_start = max(0, cx_start)
+            cx_end = min((self.tilemap.width - 1) // cs, cx_end)
+        cy_start = max(0, ty // cs)
+        cy_end = min((self.tilemap.height - 1) // cs, (ty + view_size[1] - 1) // cs)
+        self.view.fblits(
+            [
+                (self.get_chunk((cx, cy)), (cx * cs - tx, cy * cs - ty))
+                for cy in range(cy_start, cy_end + 1)
+                for cx in range(cx_start, cx_end + 1)
+            ]
+        )
+
+        pg.transform.smoothscale(self.view, self.scaled_view.get_size(), self.scaled_view)
+        surf.blit(
+            self.scaled_view,
+            ((tx - camera.x) * tile_size, (ty - camera.y) * tile_size),
+        )
@@ -0,0 +1,98 @@
+import heapq
+import numpy as np
+from collections import deque
+from settings import TILE_UPDATE_BUDGET
+from tiles import Tiles
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tilemap import Tilemap
+
+
+class TileUpdates:
+    """
+    Changing a tile queues a neighbor update for it and the 4 cells around it,
+    which calls neighbor_changed on the tiles that want them (see
+    Tile.neighbor_updates). Tiles can also schedule_tick themselves some
+    simulation steps ahead, the tick gets dropped if the tile changes before.
+
+    update runs the due ticks and then the queued neighbor updates, at most
+    budget of them per step, whatever is left waits for the next step. Cells
+    in chunks that aren't loaded are skipped
+    """
+
+    def __init__(self, tilemap: "Tilemap", budget: int = TILE_UPDATE_BUDGET):
+        self.tilemap = tilemap
+        self.budget = budget
+        self.queue: deque[tuple[int, int]] = deque()
+        self.queued: set[tuple[int, int]] = set()
+        # (due step, order, x, y, tile id) heap
+        self.ticks: list[tuple[int, int, int, int, int]] = []
+        self.scheduled: set[tuple[int, int]] = set()
+        self.step = 0
+        self.order = 0
+
+    def notify_rect(self, x: int, y: int, w: int, h: int):
+        """
+        Queues updates for the tiles of the rect and the cells around it
+        """
+        if w <= 0 or h <= 0:
+            return
+        tilemap = self.tilemap
+        y0 = max(y - 1, 0)
+        for start, stop in tilemap.loaded_spans(x - 1, x + w + 1):
+            ids = tilemap.get_region(start, y0, stop - start, y + h + 1 - y0)
+            ys, xs = np.nonzero(Tiles.neighbor_updates[ids])
+            self.enqueue(xs + start, ys + y0)
+
+    def notify_cells(self, xs: np.ndarray, ys: np.ndarray):
+        if len(xs) == 0:
+            return
+        tilemap = self.tilemap
+        xs = np.concatenate([xs, xs - 1, xs + 1, xs, xs])
+        ys = np.concatenate([ys, ys, ys, ys - 1, ys + 1])
+        inside = (ys >= 0) & (ys < tilemap.height) & tilemap.loaded_columns(xs)
+        xs, ys = xs[inside], ys[inside]
+        reacts = Tiles.neighbor_updates[tilemap.get_ids(xs, ys)]
+        self.enqueue(xs[reacts], ys[reacts])
+
+    def enqueue(self, xs: np.ndarray, ys: np.ndarray):
+        for cell in zip(xs.tolist(), ys.tolist()):
+            if cell not in self.queued:
+                self.queued.add(cell)
+                self.queue.append(cell)
+
+    def schedule_tick(self, x: int, y: int, delay: int):
+        """
+        Calls scheduled_tick on the tile at (x, y) in delay steps, if it's
+        still the same tile then. A cell has at most one tick waiting
+        """
+        if (x, y) in self.scheduled:
+            return
+        self.scheduled.add((x, y))
+        self.order += 1
+        heapq.heappush(
+            self.ticks, (self.step + delay, self.order, x, y, self.tilemap.get_id(x, y))
+        )
+
+    def update(self):
+        self.step += 1
+        tilemap = self.tilemap
+        budget = self.budget
+        ticks = self.ticks
+        while budget and ticks and ticks[0][0] <= self.step:
+            _, _, x, y, tile_id = heapq.heappop(ticks)
+            self.scheduled.discard((x, y))
+            budget -= 1
+            if tilemap.loaded_spans(x, x + 1) and tilemap.get_id(x, y) == tile_id:
+                Tiles.registry[tile_id].scheduled_tick(tilemap, x, y)
+
+        queue = self.queue
+        while budget and queue:
+            x, y = cell = queue.popleft()
+            self.queued.discard(cell)
+            budget -= 1
+            if tilemap.loaded_spans(x, x + 1):
+                tile = tilemap.get_tile(cell)
+                if tile is not None and tile.neighbor_updates:
+                    tile.neighbor_changed(tilemap, x, y)
@@ -1,11 +1,17 @@
 import pygame as pg
+import numpy as np
 from settings import *
-from tiles import Tile, Water
+from tiles import Tile, Tiles
 from typing import Union, Optional, TYPE_CHECKING
 from customtypes import Coordinate
-from inspect import isclass
-from tools import Timer
+from math import floor
 from components.collider import Collider
+from chunk_cache import ChunkCache
+from tile_light import TileLight
+from water import WaterSim, water_levels
+from tile_updates import TileUpdates
+from world_gen import GEN_CHUNK_WIDTH
+from world_file import WorldFile, ChunkData
 if TYPE_CHECKING:
     from world import World
     from player import GameObject
@@ -13,30 +19,29 @@ if TYPE_CHECKING:
 
 class Tilemap:
     def __init__(self, width: int, height: int):
-        self.tiles: list[list[Optional["Tile"]]] = [
-            [None for _ in range(width)] for _ in range(height)
-        ]
-        self.tile_entities = []
+        # tile ids indexed [y, x], see Tiles.registry
+        self.grid = np.zeros((height, width), dtype=np.uint16)
         self.width = width
         self.height = height
-        self.tile_entity_timer = Timer(0.2)
+        self.chunk_cache = ChunkCache(self)
+        # light level of every tile indexed [y, x], see TileLight
+        self.light_grid = np.zeros((height, width), dtype=np.uint8)
+        self.tile_light = TileLight(self)
+        self.tile_light.invalidate(0, width)
+        # water level of every cell indexed [y, x], see WaterSim
+        self.water_grid = np.zeros((height, width), dtype=np.float32)
+        self.water_sim = WaterSim(self)
+        self.tile_updates = TileUpdates(self)
+        self.seed: Optional[int] = None
+        self.world_file: Optional[WorldFile] = None
+        # GEN_CHUNK_WIDTH column chunks changed since the last save
+        self.modified: set[int] = set()
+        # chunks only in world_file so far, they get read the first time
+        # something touches their tiles, see load_columns
+        self.unloaded: set[int] = set()
 
     def draw(self, surf: pg.Surface, camera: pg.Vector2 = pg.Vector2(0, 0)):
-        # cords for clipping
-        y_start = max(0, int(-camera.y))
-        x_start = max(0, int(-camera.x))
-        y_end = min(self.height, int((-camera.y + HEIGHT / TILE_SIZE) + 1))
-        x_end = min(self.width, int((-camera.x + WIDTH / TILE_SIZE) + 1))
-
-        # love list comprehension
-        surf.fblits(
-            [
-                (tile.img, ((x + camera.x) * TILE_SIZE, (y + camera.y) * TILE_SIZE))
-                for y, row in enumerate(self.tiles[y_start:y_end], y_start)
-                for x, tile in enumerate(row[x_start:x_end], x_start)
-                if (tile is not None)
-            ]
-        )
+        self.chunk_cache.draw(surf, camera)
 
     def is_inside(self, pos: Coordinate) -> bool:
         return (0 <= pos[0] < self.width) and (0 <= pos[1] < self.height)
@@ -45,45 +50,469 @@ class Tilemap:
         """
         Returns True if the tile at pos has is collidable (has a rect)
         """
-        tile = self.get_tile(pos)
-        return tile is not None and tile.rect is not None
+        return bool(Tiles.collidable[self.get_id(*self.clamp(pos))])
+
+    def clamp(self, pos: Coordinate) -> tuple[int, int]:
+        return (
+            min(max(int(pos[0]), 0), self.width - 1),
+            min(max(int(pos[1]), 0), self.height - 1),
+        )
 
     def set_tile(
         self, pos: Coordinate, val: Union[Tile, None], replace: bool = True
     ) -> bool:
-        if not replace and self.get_tile(pos):
-            return False
         if not self.is_inside(pos):
             return False
+        x, y = floor(pos[0]), floor(pos[1])
+        if self.unloaded:
+            self.load_columns(x, x + 1)
+        if not replace and self.get_id(x, y):
+            return False
 
-        if isclass(val) and issubclass(Water, val):
-            val = val()
-            self.tile_entities.append(val)
-            val.pos = pos
-
-        self.tiles[int(pos[1])][int(pos[0])] = val
+        self.chunk_cache.invalidate(x, y)
+        self.tile_light.invalidate(x, x + 1)
+        # new water starts out full
+        self.set_water_region(x, y, np.zeros((1, 1), dtype=np.float32))
+        self.modified.add(x // GEN_CHUNK_WIDTH)
+        self.set_id(x, y, 0 if val is None else val.id)
+        # after the id is written so the new tile gets queued too
+        self.water_sim.wake(x, y, 1, 1)
+        self.tile_updates.notify_rect(x, y, 1, 1)
         return True
 
     def get_tile(self, pos: Coordinate) -> Union[Tile, None]:
-        x = pg.math.clamp(pos[0], 0, self.width - 1)
-        y = pg.math.clamp(pos[1], 0, self.height - 1)
-        return self.tiles[int(y)][int(x)]
+        x, y = self.clamp(pos)
+        return Tiles.registry[self.get_id(x, y)]
+
+    def get_id(self, x: int, y: int) -> int:
+        if self.unloaded:
+            self.load_columns(x, x + 1)
+        return self.grid.item(y, x)
+
+    def set_id(self, x: int, y: int, tile_id: int):
+        if self.unloaded:
+            self.load_columns(x, x + 1)
+        self.grid[y, x] = tile_id
+
+    def get_ids(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Vectorized get_id for int arrays, cells outside the map get clamped like get_tile
+        """
+        xs = xs.clip(0, self.width - 1)
+        if self.unloaded:
+            for chunk_index in np.unique(xs // GEN_CHUNK_WIDTH).tolist():
+                if chunk_index in self.unloaded:
+                    self.load_chunk(chunk_index)
+        return self.grid[ys.clip(0, self.height - 1), xs]
+
+    def load_columns(self, x0: int, x1: int):
+        """
+        Reads the chunks of columns [x0, x1) that are still only in the world file
+        """
+        x0, x1 = max(x0, 0), min(x1, self.width)
+        if x1 <= x0:
+            return
+        for chunk_index in range(x0 // GEN_CHUNK_WIDTH, (x1 - 1) // GEN_CHUNK_WIDTH + 1):
+            if chunk_index in self.unloaded:
+                self.load_chunk(chunk_index)
+
+    def load_chunk(self, chunk_index: int) -> np.ndarray:
+        self.unloaded.discard(chunk_index)
+        ids, water = self.world_file.read_chunk(chunk_index)
+        x0 = chunk_index * GEN_CHUNK_WIDTH
+        self.grid[:, x0 : x0 + ids.shape[1]] = ids
+        self.restore_water(water)
+        # the light was left dark while the chunk wasn't loaded
+        self.tile_light.invalidate(x0, x0 + ids.shape[1])
+        return ids
 
     def set_tiles(
         self, pos: Coordinate, vals: list[list[Optional[Tile]]], replace: bool = True
+    ) -> dict[Tile, int]:
+        """
+        Writes the rows of tiles with the first one at pos, None clears the cell.
+        Returns the tiles that got replaced, see edit_region
+        """
+        x, y = floor(pos[0]), floor(pos[1])
+        ids = np.array(
+            [[0 if tile is None else tile.id for tile in row] for row in vals],
+            dtype=np.uint16,
+        ).reshape(len(vals), -1)
+        return self.edit_region(x, y, np.ones(ids.shape, dtype=bool), ids, replace)
+
+    def edit_region(
+        self,
+        x: int,
+        y: int,
+        mask: np.ndarray,
+        ids: Union[np.ndarray, int],
+        replace: bool = True,
+        where: Optional[np.ndarray] = None,
+    ) -> dict[Tile, int]:
+        """
+        Writes ids (an array shaped like mask or one id) into the cells of the
+        rect at (x, y) where mask is set, with replace=False only into empty
+        cells and with where (a bool per tile id like Tiles.collidable) only
+        over those tiles. Unlike set_region it can clear cells.
+
+        All the cells go through one set_cells, so the chunk cache, lighting,
+        water and tile updates get told once for the whole edit. Returns how
+        many of every tile got replaced, air and water don't drop anything
+        """
+        h, w = mask.shape
+        rows, cols = self.region_slices(x, y, w, h)
+        clip = (slice(rows.start - y, rows.stop - y), slice(cols.start - x, cols.stop - x))
+        old = self.get_region(x, y, w, h)
+        ids = np.broadcast_to(np.asarray(ids, dtype=np.uint16), mask.shape)[clip]
+        changed = mask[clip] & (old != ids)
+        if not replace:
+            changed &= old == 0
+        if where is not None:
+            changed &= where[old]
+        ys, xs = np.nonzero(changed)
+        if len(xs) == 0:
+            return {}
+
+        counts = np.bincount(old[ys, xs], minlength=len(Tiles.registry))
+        counts[[0, Tiles.WATER.id]] = 0
+        drops = {
+            Tiles.registry[tile_id]: int(counts[tile_id])
+            for tile_id in np.nonzero(counts)[0].tolist()
+        }
+
+        new_ids = ids[ys, xs]
+        xs, ys = xs + cols.start, ys + rows.start
+        # new water starts out full, like set_tile
+        levels = self.get_water_region(cols.start, rows.start, *changed.shape[::-1])
+        if levels.any():
+            levels[changed] = 0
+            self.set_water_region(cols.start, rows.start, levels)
+        self.set_cells(xs, ys, new_ids)
+        return drops
+
+    def fill_rect(
+        self,
+        x: int,
+        y: int,
+        w: int,
+        h: int,
+        tile: Optional[Tile],
+        where: Optional[np.ndarray] = None,
+    ) -> dict[Tile, int]:
+        """
+        Sets every cell of the rect to tile (None clears), see edit_region
+        """
+        return self.apply_mask((x, y), np.ones((max(h, 0), max(w, 0)), dtype=bool), tile, where)
+
+    def fill_circle(
+        self,
+        center: Coordinate,
+        radius: float,
+        tile: Optional[Tile],
+        where: Optional[np.ndarray] = None,
+    ) -> dict[Tile, int]:
+        """
+        Sets the cells whose centers are within radius of center, see edit_region
+        """
+        return self.fill_circles([center], radius, tile, where)
+
+    def fill_circles(
+        self,
+        centers: list[Coordinate],
+        radius: float,
+        tile: Optional[Tile],
+        where: Optional[np.ndarray] = None,
+    ) -> dict[Tile, int]:
+        """
+        fill_circle for all of centers at once, the circles get merged into one
+        mask over their bounding box so it's still a single edit_region
+        """
+        if not centers:
+            return {}
+        x0 = min(floor(cx - radius) for cx, _ in centers)
+        y0 = min(floor(cy - radius) for _, cy in centers)
+        x1 = max(floor(cx + radius) for cx, _ in centers) + 1
+        y1 = max(floor(cy + radius) for _, cy in centers) + 1
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for cx, cy in centers:
+            cx0, cy0 = floor(cx - radius), floor(cy - radius)
+            cx1, cy1 = floor(cx + radius) + 1, floor(cy + radius) + 1
+            xs = np.arange(cx0, cx1) + 0.5 - cx
+            ys = np.arange(cy0, cy1) + 0.5 - cy
+            mask[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0] |= (
+                xs[None, :] ** 2 + ys[:, None] ** 2 <= radius**2
+            )
+        return self.apply_mask((x0, y0), mask, tile, where)
+
+    def apply_mask(
+        self,
+        pos: Coordinate,
+        mask: np.ndarray,
+        tile: Optional[Tile],
+        where: Optional[np.ndarray] = None,
+    ) -> dict[Tile, int]:
+        """
+        Sets the cells where mask is set to tile, mask's top left corner is at pos
+        """
+        tile_id = 0 if tile is None else tile.id
+        return self.edit_region(floor(pos[0]), floor(pos[1]), mask, tile_id, where=where)
+
+    def replace_where(
+        self,
+        x: int,
+        y: int,
+        w: int,
+        h: int,
+        old: Union[Tile, list[Tile]],
+        tile: Optional[Tile],
+    ) -> dict[Tile, int]:
+        """
+        Replaces the old tiles in the rect with tile
+        """
+        where = np.zeros(len(Tiles.registry), dtype=bool)
+        where[[t.id for t in (old if isinstance(old, list) else [old])]] = True
+        return self.fill_rect(x, y, w, h, tile, where)
+
+    def region_slices(self, x: int, y: int, w: int, h: int) -> tuple[slice, slice]:
+        """
+        (row, column) slices of the grid for the rect, clipped to the map
+        """
+        return (
+            slice(min(max(y, 0), self.height), min(max(y + h, 0), self.height)),
+            slice(min(max(x, 0), self.width), min(max(x + w, 0), self.width)),
+        )
+
+    def get_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """
+        Returns a view of the tile ids inside the rect, clipped to the map
+        """
+        if self.unloaded:
+            self.load_columns(x, x + w)
+        return self.grid[self.region_slices(x, y, w, h)]
+
+    def get_collidable_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        return Tiles.collidable[self.get_region(x, y, w, h)]
+
+    def set_region(self, pos: Coordinate, ids: np.ndarray, replace: bool = True):
+        """
+        Writes an array of tile ids with its top left corner at pos.
+        Ids of 0 are skipped, with replace=False only empty cells are written
+        """
+        x, y = floor(pos[0]), floor(pos[1])
+        h, w = ids.shape
+        rows, cols = self.region_slices(x, y, w, h)
+        ids = ids[rows.start - y : rows.stop - y, cols.start - x : cols.stop - x]
+        if self.unloaded:
+            self.load_columns(cols.start, cols.stop)
+        self.write_region(self.grid[rows, cols], ids, cols.start, rows.start, replace)
+        self.chunk_cache.invalidate_rect(
+            cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start
+        )
+        self.tile_light.invalidate(cols.start, cols.stop)
+        self.water_sim.wake(
+            cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start
+        )
+        self.tile_updates.notify_rect(
+            cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start
+        )
+        if cols.stop > cols.start:
+            self.modified.update(
+                range(cols.start // GEN_CHUNK_WIDTH, (cols.stop - 1) // GEN_CHUNK_WIDTH + 1)
+            )
+
+    def write_region(
+        self, target: np.ndarray, ids: np.ndarray, x: int, y: int, replace: bool
+    ):
+        """
+        set_region on a storage view, (x, y) is the map position of target[0, 0]
+        """
+        mask = ids != 0
+        if not replace:
+            mask &= target == 0
+        target[mask] = ids[mask]
+
+    def set_cells(
+        self, xs: np.ndarray, ys: np.ndarray, ids: np.ndarray, replace: bool = True
     ):
-        for y, row in enumerate(vals, int(pos[1])):
-            for x, tile in enumerate(row, int(pos[0])):
-                self.set_tile((x, y), tile, replace=replace)
+        """
+        Scatter version of set_region, writes ids[i] at (xs[i], ys[i]).
+        Cells outside the map are skipped, which write wins for duplicate cells is unspecified
+        """
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys, ids = xs[inside], ys[inside], ids[inside]
+        if self.unloaded and len(xs):
+            self.get_ids(xs, ys)
+        xs, ys = self.write_cells(self.grid, xs, ys, ids, 0, replace)
+        self.chunk_cache.invalidate_cells(xs, ys)
+        if len(xs):
+            self.tile_light.invalidate(int(xs.min()), int(xs.max()) + 1)
+        self.water_sim.wake_cells(xs, ys)
+        self.tile_updates.notify_cells(xs, ys)
+        self.modified.update(np.unique(xs // GEN_CHUNK_WIDTH).tolist())
+
+    def write_cells(
+        self,
+        target: np.ndarray,
+        xs: np.ndarray,
+        ys: np.ndarray,
+        ids: np.ndarray,
+        x: int,
+        replace: bool,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        set_cells on a storage array whose first column is map column x,
+        returns the map cells that were written
+        """
+        local_xs = xs - x
+        if not replace:
+            empty = target[ys, local_xs] == 0
+            xs, local_xs, ys, ids = xs[empty], local_xs[empty], ys[empty], ids[empty]
+        target[ys, local_xs] = ids
+        return xs, ys
+
+    def read_layer(self, layer: np.ndarray, dtype, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """
+        Copy of the rect of a per cell layer like the light levels, 0 outside the map
+        """
+        values = np.zeros((h, w), dtype=dtype)
+        rows, cols = self.region_slices(x, y, w, h)
+        values[rows.start - y : rows.stop - y, cols.start - x : cols.stop - x] = (
+            layer[rows, cols]
+        )
+        return values
+
+    def write_layer(self, layer: np.ndarray, x: int, y: int, values: np.ndarray):
+        h, w = values.shape
+        rows, cols = self.region_slices(x, y, w, h)
+        layer[rows, cols] = values[
+            rows.start - y : rows.stop - y, cols.start - x : cols.stop - x
+        ]
+
+    def get_light_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        return self.read_layer(self.light_grid, np.uint8, x, y, w, h)
+
+    def set_light_region(self, x: int, y: int, levels: np.ndarray):
+        self.write_layer(self.light_grid, x, y, levels)
+
+    def get_water_region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """
+        The stored water levels, see water_levels for how full the cells are
+        """
+        return self.read_layer(self.water_grid, np.float32, x, y, w, h)
+
+    def set_water_region(self, x: int, y: int, levels: np.ndarray):
+        self.write_layer(self.water_grid, x, y, levels)
+
+    def loaded_spans(self, x0: int, x1: int) -> list[tuple[int, int]]:
+        """
+        The parts of columns [x0, x1) TileLight and WaterSim can work on,
+        they never load chunks
+        """
+        x0, x1 = max(x0, 0), min(x1, self.width)
+        if x1 <= x0:
+            return []
+        if not self.unloaded:
+            return [(x0, x1)]
+        spans = []
+        for chunk_index in range(x0 // GEN_CHUNK_WIDTH, (x1 - 1) // GEN_CHUNK_WIDTH + 1):
+            if chunk_index in self.unloaded:
+                continue
+            start = max(x0, chunk_index * GEN_CHUNK_WIDTH)
+            stop = min(x1, (chunk_index + 1) * GEN_CHUNK_WIDTH)
+            if spans and spans[-1][1] == start:
+                spans[-1] = (spans[-1][0], stop)
+            else:
+                spans.append((start, stop))
+        return spans
+
+    def loaded_columns(self, xs: np.ndarray) -> np.ndarray:
+        """
+        Vectorized loaded_spans, which columns can be worked on
+        """
+        inside = (xs >= 0) & (xs < self.width)
+        if self.unloaded:
+            inside &= ~np.isin(xs // GEN_CHUNK_WIDTH, list(self.unloaded))
+        return inside
+
+    def draw_light(self, surf: pg.Surface, camera: pg.Vector2, scale: int = 1):
+        self.tile_light.draw(surf, camera, scale)
 
     def get_tile_coords(self, pos: Coordinate):
         tile_coords = pos
         return tile_coords if self.is_inside(tile_coords) else False
 
     def update(self, world: "World"):
-        if self.tile_entity_timer.tick(world.dt):
-            for ent in self.tile_entities:
-                ent.update(self)
+        self.water_sim.update(world.dt)
+        self.tile_updates.update()
+        self.tile_light.update()
+
+    def save(self, path: Optional[str] = None, wait: bool = True):
+        """
+        Saves the chunks changed since the last save, or all of them when saving
+        to a new path. With wait=False compressing and writing the chunks happens
+        on the world file's background thread
+        """
+        old_file = self.world_file
+        if path is not None and (old_file is None or old_file.path != path):
+            self.world_file = WorldFile.create(
+                path, self.width, self.height, GEN_CHUNK_WIDTH, self.seed or 0
+            )
+            chunk_indices = self.all_chunks()
+        else:
+            chunk_indices = self.modified
+
+        self.world_file.write(
+            {
+                chunk_index: self.chunk_data(chunk_index, old_file)
+                for chunk_index in chunk_indices
+            }
+        )
+        self.modified = set()
+        if old_file is not None and old_file is not self.world_file:
+            old_file.close()
+        if wait:
+            self.world_file.flush()
+
+    def all_chunks(self) -> list[int]:
+        return list(range(-(-self.width // GEN_CHUNK_WIDTH)))
+
+    def chunk_data(
+        self, chunk_index: int, old_file: Optional[WorldFile] = None
+    ) -> ChunkData:
+        """
+        Copy of a column chunk for saving
+        """
+        # saving to a new file copies the chunks that were never read over as they are
+        if chunk_index in self.unloaded:
+            return (old_file or self.world_file).read_chunk(chunk_index)
+        x0 = chunk_index * GEN_CHUNK_WIDTH
+        return (
+            self.grid[:, x0 : x0 + GEN_CHUNK_WIDTH].copy(),
+            self.chunk_water(chunk_index),
+        )
+
+    def chunk_water(self, chunk_index: int) -> np.ndarray:
+        """
+        (x, y, water level) rows of the water cells of a column chunk
+        """
+        x0 = chunk_index * GEN_CHUNK_WIDTH
+        ids = self.get_region(x0, 0, GEN_CHUNK_WIDTH, self.height)
+        levels = water_levels(ids, self.get_water_region(x0, 0, ids.shape[1], self.height))
+        ys, xs = np.nonzero(levels)
+        return np.stack([xs + x0, ys, levels[ys, xs]], axis=1).astype(np.float32)
+
+    def restore_water(self, water: np.ndarray):
+        xs, ys = water[:, 0].astype(int), water[:, 1].astype(int)
+        self.water_grid[ys, xs] = water[:, 2]
+        self.water_sim.wake_cells(xs, ys)
+
+    @classmethod
+    def from_file(cls, world_file: WorldFile) -> "Tilemap":
+        tilemap = cls(world_file.width, world_file.height)
+        tilemap.seed = world_file.seed
+        tilemap.world_file = world_file
+        tilemap.unloaded = set(world_file.chunk_indices())
+        return tilemap
 
     def get_collisions(self, game_object: "GameObject") -> list[pg.FRect]:
         collider = game_object.components[Collider]
@@ -1,9 +1,11 @@
 from customtypes import Coordinate
 import pygame as pg
+import numpy as np
+from math import ceil
 
 from item import Item
 from typing import Optional, TYPE_CHECKING
-from settings import TILE_SIZE
+from settings import TILE_SIZE, MAX_TILE_LIGHT
 
 if TYPE_CHECKING:
     from tilemap import Tilemap
@@ -13,6 +15,11 @@ if TYPE_CHECKING:
 
 
 class Tile(Item):
+    # set by Tiles.register, index into Tiles.registry
+    id: int
+    # gets neighbor_changed calls, see TileUpdates
+    neighbor_updates = False
+
     def __init__(
         self,
         img_path: str,
@@ -21,11 +28,30 @@ class Tile(Item):
         rect: Optional[pg.FRect] = pg.FRect(0, 0, 1, 1),
         break_time: float = 0.5,
         break_level: int = 0,
+        light_opacity: Optional[int] = None,
+        light_emission: int = 0,
     ):
         super().__init__(img_path, name, max_stack)
         self.rect = rect
         self.break_time = break_time
         self.break_level = break_level
+        # how much extra light the tile swallows on top of the 1 every step loses,
+        # solid tiles block all of it by default
+        if light_opacity is None:
+            light_opacity = MAX_TILE_LIGHT if rect is not None else 0
+        self.light_opacity = light_opacity
+        # light level the tile glows with
+        self.light_emission = light_emission
+
+    def neighbor_changed(self, tilemap: "Tilemap", x: int, y: int):
+        """
+        Called when this tile or one next to it changed
+        """
+
+    def scheduled_tick(self, tilemap: "Tilemap", x: int, y: int):
+        """
+        Called when a tick scheduled with TileUpdates.schedule_tick is due
+        """
 
     def collide(self, pos: Coordinate, other_rect: pg.FRect):
         if self.rect == None:
@@ -36,7 +62,7 @@ class Tile(Item):
     def right_click(self, world: "World", component: "Player2", item_stack: "ItemStack"):
         tile_pos = tile_pos = world.get_mouse_tile_pos()
         if component.owner.pos.distance_to(tile_pos) <= component.reach:
-            if not world.cs.collision_dict.get(tuple(tile_pos)):
+            if not world.cs.query_rect(pg.FRect(tile_pos, (1, 1))):
                 if world.tilemap.set_tile(
                     tile_pos, self, replace=False
                 ):
@@ -48,101 +74,95 @@ class Tile(Item):
         return f"<{self.__class__}{self.__dict__}>"
 
 
+class Plant(Tile):
+    """
+    Needs a solid tile under it, pops off a few steps after losing it
+    """
+
+    neighbor_updates = True
+    break_delay = 6
+
+    def supported(self, tilemap: "Tilemap", x: int, y: int) -> bool:
+        return y + 1 < tilemap.height and tilemap.is_tile_collidable((x, y + 1))
+
+    def neighbor_changed(self, tilemap: "Tilemap", x: int, y: int):
+        if not self.supported(tilemap, x, y):
+            tilemap.tile_updates.schedule_tick(x, y, self.break_delay)
+
+    def scheduled_tick(self, tilemap: "Tilemap", x: int, y: int):
+        if not self.supported(tilemap, x, y):
+            tilemap.set_tile((x, y), None)
+
+
 class Water(Tile):
-    img_cache = {}
-    max_water_level = 4
-    def __init__(
-        self,
-        img_path: str = "",
-        name: str = "water",
-        max_stack: int = 64,
-        rect: pg.FRect | None = None,
-        break_time: float = 0.5,
-        break_level: int = 0,
-    ):
-        super().__init__(img_path, name, max_stack, rect, break_time, break_level)
-        self._pos = pg.Vector2()
-        self.water_level = self.max_water_level
-        self.last_dir = pg.Vector2(1, 0)
-        self.grounded = False
+    """
+    Every water cell shares the one WATER tile, how full a cell is gets kept
+    by the tilemap and simulated by WaterSim (see water.py)
+    """
 
-    @property
-    def pos(self):
-        return self._pos
-
-    def update(self, tilemap: "Tilemap"):
-        new_pos = self._pos + pg.Vector2(0, 1)
-        tile = tilemap.get_tile(new_pos)
-        if isinstance(tile, Water):
-            if tile.water_level >= self.max_water_level:
-                self.grounded = True
-            else:
-                new_level = tile.water_level + self.water_level
-                tile.water_level = min(new_level, self.max_water_level + 2)
-                self.water_level = new_level - tile.water_level
-        elif tile and tile.rect:
-            self.grounded = True
-        else:
-            self.move(tilemap, new_pos)
-            self.grounded = False
-
-        if self.grounded:
-            for new_pos in sorted(
-                [pg.Vector2(1, 0) + self._pos, pg.Vector2(-1, 0) + self._pos],
-                key=lambda pos: self.get_water_level(tilemap, pos),
-            ):
-                tile = tilemap.get_tile(new_pos)
-                if isinstance(tile, Water):
-                    total = tile.water_level + self.water_level
-                    self.water_level = total / 2
-                    tile.water_level = total - self.water_level
-                    break
-
-                elif not tile or not tile.rect:
-                    tilemap.set_tile(new_pos, Water)
-                    new_water = tilemap.get_tile(new_pos)
-                    prev_level = self.water_level
-                    self.water_level = self.water_level / 2
-                    new_water.water_level = prev_level - self.water_level
-                    break
-
-            # self.last_dir = -self.last_dir
-        if self.water_level <= 0:
-            tilemap.set_tile(self._pos, None)
-            tilemap.tile_entities.remove(self)
-
-    def get_water_level(self, tilemap: "Tilemap", pos: Coordinate):
-        tile = tilemap.get_tile(pos)
-        if isinstance(tile, Water):
-            return tile.water_level
-        return 0
+    img_cache: dict[int, pg.Surface] = {}
+    max_water_level = 4
 
     @property
     def img(self):
-        key = round(self.water_level)
-        if img := self.img_cache.get(key, None):
-            pass
-        else:
-            img = pg.Surface((16, 16), pg.SRCALPHA)
-            img.fill((0, 0, 255, 125), (0, 16 - key / self.max_water_level * TILE_SIZE, 16, key / self.max_water_level * TILE_SIZE))
-            self.img_cache[key] = img
+        return self.level_img(self.max_water_level)
+
+    @classmethod
+    def level_img(cls, level: float) -> pg.Surface:
+        height = min(max(ceil(level / cls.max_water_level * TILE_SIZE), 1), TILE_SIZE)
+        if (img := cls.img_cache.get(height)) is None:
+            img = pg.Surface((TILE_SIZE, TILE_SIZE), pg.SRCALPHA)
+            img.fill((0, 0, 255, 125), (0, TILE_SIZE - height, TILE_SIZE, height))
+            cls.img_cache[height] = img
         return img
 
-    def move(self, tilemap: "Tilemap", new_pos: pg.Vector2):
-        tilemap.set_tile(new_pos, self)
-        tilemap.set_tile(self._pos, None)
-        self._pos = new_pos
-
-    @pos.setter
-    def pos(self, pos: Coordinate):
-        self._pos = pg.Vector2(pos)
-
 
 class Tiles:
     DIRT = Tile("textures/1.png", "Dirt", break_time=0.5)
     GRASS = Tile("textures/7.png", "Grass", break_time=0.5)
     STONE = Tile("textures/3.png", "Stone")
-    GRASS_PLANT = Tile("textures/8.png", "Grass Plant", rect=None, break_time=0.1)
+    GRASS_PLANT = Plant("textures/8.png", "Grass Plant", rect=None, break_time=0.1)
     WOOD = Tile("textures/5.png", "Wood")
-    LEAF = Tile("textures/9.png", "Leaf", break_time=0.2)
-    WATER = Water
+    LEAF = Tile("textures/9.png", "Leaf", break_time=0.2, light_opacity=1)
+    WATER = Water("", "Water", rect=None, light_opacity=2)
+
+    # tile id -> tile, id 0 is always air (None)
+    registry: list[Optional[Tile]] = [None]
+    # tile id -> attribute name, saves store these since ids can change between versions
+    keys: list[str] = ["AIR"]
+    # tile id -> has a rect, for vectorized collision queries
+    collidable: np.ndarray = np.zeros(1, dtype=bool)
+    # tile id -> light_opacity and light_emission, see TileLight
+    light_opacity: np.ndarray = np.zeros(1, dtype=np.int16)
+    light_emission: np.ndarray = np.zeros(1, dtype=np.int16)
+    # tile id -> wants neighbor_changed calls
+    neighbor_updates: np.ndarray = np.zeros(1, dtype=bool)
+
+    @classmethod
+    def register(cls, tile: Tile, key: str) -> int:
+        tile.id = len(cls.registry)
+        cls.registry.append(tile)
+        cls.keys.append(key)
+        cls.collidable = np.array(
+            [getattr(t, "rect", None) is not None for t in cls.registry], dtype=bool
+        )
+        cls.light_opacity = np.array(
+            [getattr(t, "light_opacity", 0) for t in cls.registry], dtype=np.int16
+        )
+        cls.light_emission = np.array(
+            [getattr(t, "light_emission", 0) for t in cls.registry], dtype=np.int16
+        )
+        cls.neighbor_updates = np.array(
+            [getattr(t, "neighbor_updates", False) for t in cls.registry], dtype=bool
+        )
+        return tile.id
+
+    @classmethod
+    def get(cls, tile_id: int) -> Optional[Tile]:
+        return cls.registry[tile_id]
+
+
+for _name, _tile in list(vars(Tiles).items()):
+    if _name.isupper():
+        Tiles.register(_tile, _name)
+
@@ -0,0 +1,206 @@
+import numpy as np
+from settings import WATER_TICK, WATER_BLOCK
+from tiles import Tiles, Water
+from tools import Timer
+from world_gen import GEN_CHUNK_WIDTH
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tilemap import Tilemap
+
+MAX_LEVEL = Water.max_water_level
+# water thinner than this dries up
+MIN_LEVEL = 0.05
+# neighbours closer than this don't flow into each other, so puddles settle
+SETTLE_DIFF = 0.05
+# cells need this much water to spill into an empty neighbour
+MIN_SPILL = 0.5
+# smaller changes don't keep a block awake
+CHANGED = 1e-3
+
+
+def water_levels(ids: np.ndarray, levels: np.ndarray) -> np.ndarray:
+    """
+    How full the cells are, levels only count where the tile is water and
+    water tiles without a level (placed with set_tile, set_region...) are full
+    """
+    water = ids == Tiles.WATER.id
+    return np.where(water, np.where(levels > 0, levels, MAX_LEVEL), 0).astype(np.float32)
+
+
+def flow(levels: np.ndarray, open_: np.ndarray) -> np.ndarray:
+    """
+    One tick of the automaton. Water falls into the cell below as far as it
+    has room. Connected water resting on something evens out across the row,
+    and spills a third of the difference into the cells next to it. open_ is
+    where water can go, the edges of the arrays are walls
+    """
+    levels = levels.copy()
+    room = np.zeros_like(levels)
+    room[:-1] = np.where(open_[1:], MAX_LEVEL - levels[1:], 0).clip(0)
+    fall = np.minimum(levels, room)
+    levels -= fall
+    levels[1:] += fall[:-1]
+
+    # runs of water in a row that can't fall any further level out right away,
+    # spreading cell by cell would take ages to settle on a big lake
+    resting = levels > 0
+    resting[:-1] &= ~open_[1:] | (levels[1:] >= MAX_LEVEL - CHANGED)
+    run_start = resting.copy()
+    run_start[:, 1:] &= ~resting[:, :-1]
+    runs = (np.cumsum(run_start) - 1).reshape(levels.shape)
+    totals = np.bincount(runs[resting], levels[resting])
+    counts = np.bincount(runs[resting])
+    levels[resting] = (totals / counts)[runs[resting]]
+
+    # water going from column x + 1 to x and from x to x + 1
+    diff = levels[:, 1:] - levels[:, :-1]
+    left = np.where(
+        open_[:, :-1]
+        & (diff > SETTLE_DIFF)
+        & ((levels[:, :-1] > 0) | (levels[:, 1:] > MIN_SPILL)),
+        diff / 3,
+        0,
+    )
+    right = np.where(
+        open_[:, 1:]
+        & (-diff > SETTLE_DIFF)
+        & ((levels[:, 1:] > 0) | (levels[:, :-1] > MIN_SPILL)),
+        -diff / 3,
+        0,
+    )
+    levels[:, 1:] -= left
+    levels[:, :-1] += left
+    levels[:, :-1] -= right
+    levels[:, 1:] += right
+    levels[levels < MIN_LEVEL] = 0
+    return levels
+
+
+class WaterSim:
+    """
+    Water is a level per cell kept by the tilemap next to the tile ids
+    (see Tilemap.get_water_region), cells with water have the WATER tile.
+
+    The map is split into block_size square blocks and only awake blocks get
+    simulated. Blocks wake up when tiles in or next to them change and stay
+    awake while their water moves, once it settles they go to sleep. A lake
+    that nothing touches costs nothing
+    """
+
+    def __init__(self, tilemap: "Tilemap", block_size: int = WATER_BLOCK):
+        self.tilemap = tilemap
+        # whole blocks per streamed chunk, so unloading a chunk drops whole blocks
+        assert GEN_CHUNK_WIDTH % block_size == 0
+        self.block_size = block_size
+        self.awake: set[tuple[int, int]] = set()
+        self.timer = Timer(WATER_TICK)
+
+    def wake(self, x: int, y: int, w: int, h: int):
+        """
+        Wakes the blocks of the rect and of the cells around it, unless there
+        is no water there to react
+        """
+        if w <= 0 or h <= 0:
+            return
+        tilemap = self.tilemap
+        if not any(
+            (tilemap.get_region(start, y - 1, stop - start, h + 2) == Tiles.WATER.id).any()
+            or tilemap.get_water_region(start, y - 1, stop - start, h + 2).any()
+            for start, stop in tilemap.loaded_spans(x - 1, x + w + 1)
+        ):
+            return
+        bs = self.block_size
+        self.awake.update(
+            (bx, by)
+            for by in range(max(y - 1, 0) // bs, (y + h) // bs + 1)
+            for bx in range((x - 1) // bs, (x + w) // bs + 1)
+        )
+
+    def wake_cells(self, xs: np.ndarray, ys: np.ndarray):
+        if len(xs) == 0:
+            return
+        bs = self.block_size
+        # the blocks of the cells around them too, [x - 1, x + 1] touches at most two
+        lo_x, hi_x = (xs - 1) // bs, (xs + 1) // bs
+        lo_y, hi_y = (ys - 1).clip(0) // bs, (ys + 1) // bs
+        # one int per block, y is never negative
+        keys = np.unique(
+            np.concatenate(
+                [
+                    (bx.astype(np.int64) << 32) | by
+                    for bx in (lo_x, hi_x)
+                    for by in (lo_y, hi_y)
+                ]
+            )
+        )
+        self.awake.update(zip((keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist()))
+
+    def forget(self, x0: int, x1: int):
+        """
+        Drops the blocks of columns [x0, x1), for chunks that got unloaded
+        """
+        bs = self.block_size
+        self.awake = {key for key in self.awake if not x0 // bs <= key[0] < x1 // bs}
+
+    def update(self, dt: float):
+        if self.awake and self.timer.tick(dt):
+            self.step()
+
+    def regions(self) -> list[tuple[int, int, int, int]]:
+        """
+        (x, y, w, h) rects covering the awake blocks plus a cell around them,
+        blocks next to each other go in the same rect
+        """
+        bs = self.block_size
+        tilemap = self.tilemap
+        clusters: list[list[tuple[int, int]]] = []
+        for key in sorted(self.awake):
+            if clusters and key[0] <= clusters[-1][-1][0] + 1:
+                clusters[-1].append(key)
+            else:
+                clusters.append([key])
+
+        regions = []
+        for cluster in clusters:
+            y0 = max(min(by for _, by in cluster) * bs - 1, 0)
+            y1 = min((max(by for _, by in cluster) + 1) * bs + 1, tilemap.height)
+            x0, x1 = cluster[0][0] * bs - 1, (cluster[-1][0] + 1) * bs + 1
+            for start, stop in tilemap.loaded_spans(x0, x1):
+                if y1 > y0:
+                    regions.append((start, y0, stop - start, y1 - y0))
+        return regions
+
+    def step(self):
+        regions = self.regions()
+        self.awake = set()
+        for region in regions:
+            self.simulate(*region)
+
+    def simulate(self, x: int, y: int, w: int, h: int):
+        """
+        Runs a tick on the rect, its edges act like walls
+        """
+        tilemap = self.tilemap
+        stored = tilemap.get_water_region(x, y, w, h)
+        ids = tilemap.get_region(x, y, w, h)
+        water_id = Tiles.WATER.id
+        is_water = ids == water_id
+        if not is_water.any() and not stored.any():
+            return
+        old = water_levels(ids, stored)
+        levels = flow(old, ~Tiles.collidable[ids])
+
+        # water washes away tiles without a rect, like plants
+        new_ids = np.where(levels > 0, water_id, np.where(is_water, 0, ids))
+        ys, xs = np.nonzero(new_ids != ids)
+        if len(xs):
+            tilemap.set_cells(xs + x, ys + y, new_ids[ys, xs])
+        tilemap.set_water_region(x, y, levels)
+
+        ys, xs = np.nonzero(np.abs(levels - old) > CHANGED)
+        if len(xs):
+            xs, ys = xs + x, ys + y
+            tilemap.chunk_cache.invalidate_cells(xs, ys)
+            tilemap.modified.update(np.unique(xs // GEN_CHUNK_WIDTH).tolist())
+            self.wake_cells(xs, ys)
@@ -1,18 +1,24 @@
-import random
+import os
 from tilemap import Tilemap
+from streaming_tilemap import StreamingTilemap
+from world_file import WorldFile
 
 from player import Player2, TileOverlay, Enemy1, GameObject
 from settings import *
 
 from customtypes import Coordinate
+from typing import Optional
 import pygame as pg
+import numpy as np
 
-from particle import ParticleManager, Particle
-from event import subscribe
+from particle import ParticleManager
+from profiler import Profiler
+from assets import assets
+from event import EventBus
 
 from lights import Light, LightManager
 
-from tools import hexstr2tuple
+from tools import hexstr2tuple, Timer
 
 from world_gen import WorldGenerator
 
@@ -21,103 +27,186 @@ from components.render import RenderSystem
 from components.physics import PhysicsSystem
 from components.input import InputSystem
 
+# "#10121E"
+SKY_COLOR = (16, 18, 30)
+EXPLOSION_COLORS = np.array(
+    [hexstr2tuple("#68386c"), hexstr2tuple("#b55088"), hexstr2tuple("#f6757a")]
+)
+
+
 class World:
-    def __init__(self, surface: pg.Surface):
+    """
+    Without a surface the world is headless, nothing gets drawn, played or
+    loaded from textures and it only runs the simulation. save_path None
+    never saves or loads, seed makes new worlds come out the same
+    """
+
+    def __init__(
+        self,
+        surface: Optional[pg.Surface] = None,
+        save_path: Optional[str] = None,
+        seed: Optional[int] = None,
+    ):
+        self.headless = surface is None
+        self.save_path = save_path
         self.cs = ColliderSystem()
         self.rs = RenderSystem()
         self.ps = PhysicsSystem()
         self.ins = InputSystem()
+        self.events = EventBus()
         self.pm = ParticleManager()
         self.lm = LightManager()
+        self.lm.add_source(self.pm)
+        if not self.headless:
+            # explosion and dash particles glow up to 7 * 6 pixels wide
+            Light.atlas.warmup(EXPLOSION_COLORS.tolist() + [(255, 255, 255)], 42)
+        self.rng = np.random.default_rng(seed)
 
         self.surf = surface
         self.layer0: list[GameObject] = []
-        self.tilemap = Tilemap(5000, 500)
-        self.player = Player2(
-            self.tilemap.width // 2, self.tilemap.height // 2 - 5, self
-        )
+        loaded = save_path is not None and os.path.exists(save_path)
+        if loaded:
+            world_file = WorldFile(save_path)
+            if world_file.streamed:
+                self.tilemap = StreamingTilemap.from_file(world_file)
+            else:
+                self.tilemap = Tilemap.from_file(world_file)
+        elif STREAM_WORLD:
+            self.tilemap = StreamingTilemap(500, seed)
+        else:
+            self.tilemap = Tilemap(5000, 500)
+        spawn_x = 0 if self.tilemap.width is None else self.tilemap.width // 2
+        self.player = Player2(spawn_x, self.tilemap.height // 2 - 5, self)
         self.gravity = pg.Vector2(0, 15)
         self.layer0.append(self.player)
         
-        self.cam_light = Light(75, self.player.pos, (200, 200, 200))
+        self.cam_light = self.lm.add(75, self.player.pos, (200, 200, 200), self.player)
         
         for i in range(10):
             self.layer0.append(Enemy1(*(self.player.pos - pg.Vector2(5, 5 + i)), self))
-        self.layer0.append(TileOverlay(0, 0))
+        if not self.headless:
+            self.layer0.append(TileOverlay(0, 0))
         self.camera = pg.Vector2()
 
-        WorldGenerator(self.tilemap).generate_tiles()
+        if not loaded and self.tilemap.width is not None:
+            WorldGenerator(self.tilemap, seed).generate_tiles()
+        if save_path is not None and not loaded:
+            self.tilemap.save(save_path, wait=False)
+        # light the map here, not in the first frame. Saved fixed width maps only
+        # read their chunks when touched, read the ones around the spawn first
+        self.tilemap.load_columns(spawn_x - STREAM_DISTANCE, spawn_x + STREAM_DISTANCE)
+        self.tilemap.tile_light.update()
+        self.autosave_timer = Timer(AUTOSAVE_INTERVAL)
+
+        self.dt = 1 / SIM_RATE
+        # simulation time not stepped yet, see frame
+        self.accumulator = 0.0
+        # how far rendering is between the last two simulation steps
+        self.alpha = 1.0
 
         self.debug_on: bool = False
+        self.profiler = Profiler()
         
         self.projectiles = []
+        self.events.subscribe("projectile_explosion", self.carve_explosions, batch=True)
 
         self.sounds = {}
-        self.background = self.generate_background(0.001)
-        self.background2 = self.generate_background(0.002)
-        self.background3 = self.generate_background(0.003)
-
-        subscribe("player_jump", self.play_sound_fn("jump (1).wav"))
-        subscribe("player_dash", self.play_sound_fn("jump.wav"))
-        subscribe("player_dash", self.dash_particles)
-        subscribe("player_grounded", self.play_sound_fn("hitHurt.wav"))
-        subscribe("projectile_explosion", self.play_sound_fn("explosion.wav"))
-        subscribe("projectile_explosion", self.explosion_particles)
-
-
-
-    def generate_background(self, chance):
-        background = pg.Surface(self.surf.get_size(), pg.SRCALPHA)
-        for x in range(WIDTH):
-            for y in range(HEIGHT):
-                if random.random() < chance:
-                    pg.draw.rect(background, (255, 255, 255), (x, y, 1, 1))
-        return background
-
-    def explosion_particles(self, projectile):
-        pos = projectile.pos
-        self.pm.add(
-            [
-                Particle(
-                    1 + random.uniform(-0.3, 0.5),
-                    pos+ pg.Vector2(random.uniform(0, 0.1), random.uniform(0, 0.1)), #the particle freaks out if i dont add the random ints here
-                    pg.Vector2(random.uniform(-1, 1), random.uniform(-1, 1)).normalize() * 3 * random.uniform(0, 1) - pg.Vector2(0, 3),
-                    5 + random.randint(-2, 2),
-                    [hexstr2tuple("#68386c"), hexstr2tuple("#b55088"), hexstr2tuple("#f6757a")][random.randint(0, 2)],
-                    self.gravity / 1.5
-                )
-                for i in range(40)
-            ]
+        if self.headless:
+            return
+        # the back layer is one opaque strip, the closer ones get plotted star
+        # by star on top of it, (stars, parallax)
+        self.background = self.background_strip(self.generate_background(0.001))
+        self.star_layers = [
+            (self.generate_background(0.002), 0.5),
+            (self.generate_background(0.003), 0.6),
+        ]
+
+        # sounds play once per step however many times it happened
+        events = self.events
+        events.subscribe("player_jump", self.play_sound_fn("jump (1).wav"), batch=True)
+        events.subscribe("player_dash", self.play_sound_fn("jump.wav"), batch=True)
+        events.subscribe("player_dash", self.dash_particles)
+        events.subscribe("player_grounded", self.play_sound_fn("hitHurt.wav"), batch=True)
+        events.subscribe("projectile_explosion", self.play_sound_fn("explosion.wav"), batch=True)
+        events.subscribe("projectile_explosion", self.explosion_particles, batch=True)
+
+
+
+    def generate_background(self, chance: float) -> np.ndarray:
+        """
+        Pixel positions of a screen sized starfield, every pixel is a star
+        with chance
+        """
+        return np.argwhere(self.rng.random((WIDTH, HEIGHT)) < chance)
+
+    def background_strip(self, stars: np.ndarray) -> pg.Surface:
+        """
+        The stars on the sky tiled 2x2, so any wrapped offset of it is one
+        screen sized rect
+        """
+        pixels = np.zeros((WIDTH, HEIGHT, 3), dtype=np.uint8)
+        pixels[:] = SKY_COLOR
+        pixels[stars[:, 0], stars[:, 1]] = 255
+        return pg.surfarray.make_surface(np.tile(pixels, (2, 2, 1))).convert()
+
+    def explosion_particles(self, projectiles: list[GameObject]):
+        """
+        40 particles for every projectile, emitted in one go
+        """
+        n = 40 * len(projectiles)
+        rng = self.rng
+        directions = rng.uniform(-1, 1, (n, 2))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        centers = np.repeat([tuple(projectile.pos) for projectile in projectiles], 40, axis=0)
+        self.pm.emit(
+            n,
+            # the particle freaks out if i dont add the random offset here
+            centers + rng.uniform(0, 0.1, (n, 2)),
+            directions * 3 * rng.uniform(0, 1, (n, 1)) - (0, 3),
+            1 + rng.uniform(-0.3, 0.5, n),
+            5 + rng.integers(-2, 3, n),
+            EXPLOSION_COLORS[rng.integers(0, 3, n)],
+            self.gravity / 1.5,
+        )
+
+    def carve_explosions(self, projectiles: list[GameObject]):
+        """
+        Blows a hole into the terrain around every projectile, what it
+        destroys goes into the player's inventory. All the holes of a step are
+        one edit so the caches only get invalidated once
+        """
+        drops = self.tilemap.fill_circles(
+            [projectile.pos for projectile in projectiles], EXPLOSION_RADIUS, None
         )
+        self.player.inventory.add_many(drops)
 
     def dash_particles(self, data):
+        n = 40
+        rng = self.rng
         game_object = data["game_object"]
         vec = data["vec"]
         vec = (
             pg.Vector2(-game_object.vel.x - vec.x, -game_object.vel.y / 2).normalize()
             * 5
         )
-        self.pm.add(
-            [
-                Particle(
-                    0.5 + random.uniform(-0.2, 0.2),
-                    game_object.pos
-                    + pg.Vector2(random.uniform(-0.1, 0.1), random.uniform(-0.2, 0.2)),
-                    (vec + pg.Vector2(0, i / 8 - 2)).normalize() * 10
-                    + pg.Vector2(
-                        random.uniform(-1, 1), random.uniform(-1, 1)
-                    ).normalize()
-                    * 2,
-                    6,
-                    (255, 255, 255),
-                )
-                for i in range(40)
-            ]
+        spread = np.asarray(vec) + np.stack(
+            [np.zeros(n), np.arange(n) / 8 - 2], axis=1
+        )
+        jitter = rng.uniform(-1, 1, (n, 2))
+        self.pm.emit(
+            n,
+            np.asarray(game_object.pos)
+            + rng.uniform((-0.1, -0.2), (0.1, 0.2), (n, 2)),
+            spread / np.linalg.norm(spread, axis=1, keepdims=True) * 10
+            + jitter / np.linalg.norm(jitter, axis=1, keepdims=True) * 2,
+            0.5 + rng.uniform(-0.2, 0.2, n),
+            6,
+            (255, 255, 255),
         )
 
     def get_sound(self, name: str):
         if not name in self.sounds:
-            self.sounds[name] = pg.mixer.Sound("sounds/" + name)
+            self.sounds[name] = assets.sound("sounds/" + name)
             self.sounds[name].set_volume(0.5)
         return self.sounds[name]
 
@@ -127,40 +216,45 @@ class World:
 
         return fn
 
-    def draw(self):
-        self.camera.xy = self.player.pos - pg.Vector2(WIDTH, HEIGHT) / (2 * TILE_SIZE)
-        self.cam_light.pos = self.player.pos
-        self.surf.fill("#10121E")
-
-        for pos in [
-            pg.Vector2(0, 0),
-            pg.Vector2(0, HEIGHT),
-            pg.Vector2(WIDTH, 0),
-            pg.Vector2(WIDTH, HEIGHT),
-        ]:
-            self.surf.blit(
-                self.background,
-                (-self.camera * TILE_SIZE * 0.4).elementwise()
-                % pg.Vector2(WIDTH, HEIGHT)
-                - pos,
-            )
-            self.surf.blit(
-                self.background2,
-                (-self.camera * TILE_SIZE * 0.5).elementwise()
-                % pg.Vector2(WIDTH, HEIGHT)
-                - pos,
-            )
-            self.surf.blit(
-                self.background3,
-                (-self.camera * TILE_SIZE * 0.6).elementwise()
-                % pg.Vector2(WIDTH, HEIGHT)
-                - pos,
-            )
-
-        self.tilemap.draw(self.surf, -self.camera)
-        self.rs.update(self)
-        self.pm.draw(self)
-        self.lm.draw(self)
+    def draw(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.camera.xy = self.player.render_pos(alpha) - pg.Vector2(WIDTH, HEIGHT) / (
+            2 * TILE_SIZE
+        )
+        profiler = self.profiler
+        with profiler.stage("draw"):
+            with profiler.stage("background"):
+                self.draw_background()
+            with profiler.stage("tilemap"):
+                self.tilemap.draw(self.surf, -self.camera)
+            with profiler.stage("entities"):
+                self.rs.update(self)
+            with profiler.stage("particles"):
+                self.pm.draw(self)
+            with profiler.stage("lights"):
+                self.lm.draw(self)
+
+    def draw_background(self):
+        camera = np.asarray(self.camera) * TILE_SIZE
+        x, y = np.floor(camera * 0.4).astype(int) % (WIDTH, HEIGHT)
+        self.surf.blit(self.background, (0, 0), (x, y, WIDTH, HEIGHT))
+
+        # a few hundred stars, setting the pixels beats colorkeyed screen blits
+        pixels = pg.surfarray.pixels2d(self.surf)
+        white = self.surf.map_rgb((255, 255, 255))
+        for stars, parallax in self.star_layers:
+            pos = (stars - np.floor(camera * parallax).astype(int)) % (WIDTH, HEIGHT)
+            # the surface can be smaller than the screen
+            pos = pos[(pos < pixels.shape).all(axis=1)]
+            pixels[pos[:, 0], pos[:, 1]] = white
+        del pixels
+
+    def save(self):
+        """
+        Saves the tilemap and waits for it to be written
+        """
+        if self.tilemap.world_file is not None:
+            self.tilemap.save()
 
     def get_mouse_tile_pos(self):
         mouse_pos = pg.Vector2(pg.mouse.get_pos()) / TILE_SIZE
@@ -169,17 +263,62 @@ class World:
     def draw_image(self, pos: Coordinate, image: pg.Surface):
         self.surf.blit(image, (pos - self.camera) * TILE_SIZE)
 
+    def frame(self, dt: float, render: bool = True) -> int:
+        """
+        Runs as many fixed simulation steps as fit in the time since the last
+        frame, at most MAX_SIM_STEPS, then draws unless the world is headless.
+        Returns the number of steps
+        """
+        step = 1 / SIM_RATE
+        self.accumulator += dt
+        steps = 0
+        while self.accumulator >= step and steps < MAX_SIM_STEPS:
+            self.update(step)
+            self.accumulator -= step
+            steps += 1
+        if self.accumulator >= step:
+            # too far behind to catch up, drop the whole steps
+            self.accumulator %= step
+        if render and not self.headless:
+            self.draw(self.accumulator / step)
+        self.profiler.end_frame()
+        return steps
+
     def update(self, dt: float):
+        """
+        One simulation step, doesn't draw
+        """
         self.dt = dt
-        self.cs.update()
-        self.ps.update(self)
-        self.ins.update(self)
-        self.tilemap.update(self)
-
-        self.pm.update(self)
-        for i in self.layer0:
-            i.update(self)
-        self.projectiles = [
-            projectile for projectile in self.projectiles if projectile.update(self)
-        ]
-        self.draw()
+        profiler = self.profiler
+        with profiler.stage("update"):
+            for game_object in self.layer0 + self.projectiles:
+                if game_object.prev_pos is None:
+                    game_object.prev_pos = game_object.pos.copy()
+                else:
+                    game_object.prev_pos.update(game_object.pos)
+            with profiler.stage("colliders"):
+                self.cs.update()
+            with profiler.stage("physics"):
+                self.ps.update(self)
+            with profiler.stage("input"):
+                self.ins.update(self)
+            with profiler.stage("tilemap"):
+                self.tilemap.update(self)
+                if self.tilemap.world_file is not None and self.autosave_timer.tick(dt):
+                    self.tilemap.save(wait=False)
+
+            with profiler.stage("particles"):
+                self.pm.update(self)
+            with profiler.stage("entities"):
+                for i in self.layer0:
+                    i.update(self)
+            with profiler.stage("projectiles"):
+                self.projectiles = [
+                    projectile
+                    for projectile in self.projectiles
+                    if projectile.update(self)
+                ]
+            with profiler.stage("events"):
+                self.events.dispatch()
+            with profiler.stage("lights"):
+                self.lm.remove_dead()
@@ -0,0 +1,261 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+from typing import Optional
+from tiles import Tiles
+
+MAGIC = b"S2DW"
+VERSION = 1
+# magic, version, width (-1 for streamed maps), height, chunk width, seed,
+# palette offset, palette length, index offset, index entry count
+HEADER = struct.Struct("<4sHqIIQQIQI")
+# chunk index, tile block offset, tile block length, water block offset, water block length
+INDEX_ENTRY = struct.Struct("<qQIQI")
+
+# (height, chunk width) tile ids and (n, 3) float32 rows of (x, y, water level)
+ChunkData = tuple[np.ndarray, np.ndarray]
+
+
+def write_empty(
+    path: str, width: Optional[int], height: int, chunk_width: int, seed: int, keys: list[str]
+):
+    palette = json.dumps(keys).encode()
+    with open(path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                -1 if width is None else width,
+                height,
+                chunk_width,
+                seed,
+                HEADER.size,
+                len(palette),
+                HEADER.size + len(palette),
+                0,
+            )
+        )
+        f.write(palette)
+
+
+class WorldFile:
+    """
+    Chunked binary world save.
+
+    The file starts with a fixed size header pointing at the palette (the Tiles
+    key of every tile id used in the file) and the chunk index. Every chunk is
+    a zlib compressed block of tile ids plus a block of water cells. Saving
+    appends the blocks of the changed chunks, then a new palette and index,
+    and only then rewrites the header, so a save that gets cut off leaves the
+    previous one readable. The file is read through mmap so only the blocks of
+    chunks that actually get loaded are paged in.
+
+    Writes are queued and done by a background thread, chunks that are still
+    queued are read from the queue
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending: dict[int, ChunkData] = {}
+        self.closed = False
+        self.file = open(path, "r+b")
+        self.read_header()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def create(
+        cls, path: str, width: Optional[int], height: int, chunk_width: int, seed: int = 0
+    ) -> "WorldFile":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        write_empty(path, width, height, chunk_width, seed, Tiles.keys)
+        return cls(path)
+
+    def read_header(self):
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            width,
+            self.height,
+            self.chunk_width,
+            self.seed,
+            palette_offset,
+            palette_length,
+            index_offset,
+            index_count,
+        ) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} world file")
+        self.width = None if width == -1 else width
+
+        keys = json.loads(self.mm[palette_offset : palette_offset + palette_length])
+        # the file keeps its own tile ids, tiles added since it was created go on the end
+        self.keys = keys + [key for key in Tiles.keys if key not in keys]
+        # file tile id -> current tile id, tiles that don't exist anymore become air
+        self.to_current = np.array(
+            [Tiles.keys.index(key) if key in Tiles.keys else 0 for key in self.keys],
+            dtype=np.uint16,
+        )
+        self.to_file = np.array(
+            [self.keys.index(key) for key in Tiles.keys], dtype=np.uint16
+        )
+
+        self.index: dict[int, tuple[int, int, int, int]] = {}
+        for i in range(index_count):
+            chunk_index, *entry = INDEX_ENTRY.unpack_from(
+                self.mm, index_offset + i * INDEX_ENTRY.size
+            )
+            self.index[chunk_index] = tuple(entry)
+
+    @property
+    def streamed(self) -> bool:
+        return self.width is None
+
+    def chunk_indices(self) -> list[int]:
+        with self.lock:
+            return sorted(self.index.keys() | self.pending.keys())
+
+    def has_chunk(self, chunk_index: int) -> bool:
+        with self.lock:
+            return chunk_index in self.index or chunk_index in self.pending
+
+    def read_chunk(self, chunk_index: int) -> Optional[ChunkData]:
+        with self.lock:
+            if (data := self.pending.get(chunk_index)) is not None:
+                return data[0].copy(), data[1].copy()
+            if (entry := self.index.get(chunk_index)) is None:
+                return None
+            offset, length, water_offset, water_length = entry
+            ids = zlib.decompress(self.mm[offset : offset + length])
+            water = zlib.decompress(self.mm[water_offset : water_offset + water_length])
+        ids = self.to_current[np.frombuffer(ids, dtype=np.uint16).reshape(self.height, -1)]
+        return ids, np.frombuffer(water, dtype=np.float32).reshape(-1, 3).copy()
+
+    def write(self, chunks: dict[int, ChunkData]):
+        """
+        Queues chunks for the writer thread, the arrays must not be changed afterwards
+        """
+        with self.lock:
+            self.pending.update(chunks)
+            self.changed.notify_all()
+
+    def flush(self):
+        """
+        Blocks until everything queued is on disk
+        """
+        with self.lock:
+            while self.pending:
+                self.changed.wait()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+        self.thread.join()
+        self.mm.close()
+        self.file.close()
+
+    def writer(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.changed.wait()
+                if self.closed:
+                    return
+                chunks = dict(self.pending)
+
+            # compression is the slow part and zlib lets go of the gil
+            blocks = {
+                chunk_index: (
+                    zlib.compress(self.to_file[ids].tobytes(), 1),
+                    zlib.compress(water.astype(np.float32).tobytes(), 1),
+                )
+                for chunk_index, (ids, water) in chunks.items()
+            }
+
+            with self.lock:
+                self.append(blocks)
+                # chunks queued again while compressing stay pending
+                for chunk_index, data in chunks.items():
+                    if self.pending.get(chunk_index) is data:
+                        del self.pending[chunk_index]
+                self.changed.notify_all()
+
+    def append(self, blocks: dict[int, tuple[bytes, bytes]]):
+        f = self.file
+        f.seek(0, os.SEEK_END)
+        index = dict(self.index)
+        for chunk_index, (ids_block, water_block) in blocks.items():
+            offset = f.tell()
+            f.write(ids_block)
+            f.write(water_block)
+            index[chunk_index] = (offset, len(ids_block), offset + len(ids_block), len(water_block))
+
+        palette = json.dumps(self.keys).encode()
+        palette_offset = f.tell()
+        f.write(palette)
+        index_offset = f.tell()
+        f.write(
+            b"".join(
+                INDEX_ENTRY.pack(chunk_index, *entry) for chunk_index, entry in index.items()
+            )
+        )
+        f.flush()
+        # the header goes last so a cut off save still points at the previous index
+        f.seek(0)
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                -1 if self.width is None else self.width,
+                self.height,
+                self.chunk_width,
+                self.seed,
+                palette_offset,
+                len(palette),
+                index_offset,
+                len(index),
+            )
+        )
+        f.flush()
+        self.mm.close()
+        self.read_header()
+
+        # every save leaves the old blocks of the chunks it rewrote behind
+        live = sum(entry[1] + entry[3] for entry in self.index.values())
+        if len(self.mm) > 2 * live + (1 << 20):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the file with only the current block of every chunk
+        """
+        blocks = {
+            chunk_index: (
+                self.mm[offset : offset + length],
+                self.mm[water_offset : water_offset + water_length],
+            )
+            for chunk_index, (offset, length, water_offset, water_length) in self.index.items()
+        }
+        tmp_path = self.path + ".tmp"
+        write_empty(tmp_path, self.width, self.height, self.chunk_width, self.seed, self.keys)
+        self.mm.close()
+        self.file.close()
+
+        self.file = open(tmp_path, "r+b")
+        self.read_header()
+        self.append(blocks)
+        self.mm.close()
+        self.file.close()
+
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "r+b")
+        self.read_header()
@@ -1,62 +1,226 @@
-import pygame as pg
+import numpy as np
 import opensimplex
+import os
 import time
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Callable, Optional
 from tiles import Tiles
-from customtypes import *
+
+# worlds are generated in chunks of this many columns, every chunk only depends
+# on (seed, chunk index) so this must not change with the number of workers
+GEN_CHUNK_WIDTH = 256
+BARK_LENGTHS = np.array([1, 2, 3, 4])
+BARK_WEIGHTS = np.array([1, 3, 3, 1]) / 8
+
+
+def tree_template(bark_length: int) -> np.ndarray:
+    leaf_t = Tiles.LEAF.id
+    bark_t = Tiles.WOOD.id
+    leafs = [
+        [0, leaf_t, leaf_t, leaf_t, 0],
+        [leaf_t, leaf_t, leaf_t, leaf_t, leaf_t],
+        [leaf_t, leaf_t, leaf_t, leaf_t, leaf_t],
+    ]
+    bark = [[0, 0, bark_t, 0, 0]] * bark_length
+    return np.array(leafs + bark, dtype=np.uint16)
+
+
+# (dy, dx, id) of the non empty cells of each tree, relative to the bottom of the trunk
+TREE_STAMPS = {}
+for _bark_length in BARK_LENGTHS.tolist():
+    _template = tree_template(_bark_length)
+    _dy, _dx = _template.nonzero()
+    TREE_STAMPS[_bark_length] = (
+        _dy - (_template.shape[0] - 1),
+        _dx - 2,
+        _template[_dy, _dx],
+    )
+
+
+def chunk_rng(seed: int, chunk_index: int) -> np.random.Generator:
+    # seed sequences only take non negative ints, chunks left of 0 wrap around
+    return np.random.default_rng([seed, chunk_index % (1 << 64)])
+
+
+def ground_heights(
+    noise: opensimplex.OpenSimplex, xs: np.ndarray, height: int
+) -> np.ndarray:
+    # int() truncates towards zero, so does astype
+    ground_y = (noise.noise2array(xs / 15, np.zeros(1))[0] * 8).astype(int)
+    return ground_y + height // 2
+
+
+def plan_trees(rng: np.random.Generator, ground_y: np.ndarray, x0: int) -> np.ndarray:
+    """
+    Picks the trees of a chunk as rows of (x, trunk bottom y, bark length).
+    Trees need an empty column between them, never putting one in the first
+    column of a chunk keeps that true across chunk borders
+    """
+    trees = []
+    last_tree = -1
+    for x in np.nonzero(rng.random(len(ground_y)) > 0.95)[0].tolist():
+        if last_tree + 1 < x:
+            trees.append(x)
+            last_tree = x
+    trees = np.array(trees, dtype=int)
+    bark_lengths = rng.choice(BARK_LENGTHS, size=len(trees), p=BARK_WEIGHTS)
+    return np.stack([trees + x0, ground_y[trees] - 1, bark_lengths], axis=1)
+
+
+def generate_chunk(
+    seed: int, chunk_index: int, width: int, height: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generates the terrain and grass plants of the columns starting at
+    chunk_index * GEN_CHUNK_WIDTH, without touching any global state.
+    Returns the (height, width) tile ids and the trees from plan_trees.
+    Trees get stamped separately since they can hang over into the neighbouring chunks
+    """
+    noise = opensimplex.OpenSimplex(seed)
+    rng = chunk_rng(seed, chunk_index)
+    x0 = chunk_index * GEN_CHUNK_WIDTH
+    xs = np.arange(x0, x0 + width)
+
+    ground_y = ground_heights(noise, xs, height)
+    stone_offset = (noise.noise2array(xs / 20, np.full(1, 2.0))[0] * 5).astype(int)
+
+    ys = np.arange(height)[:, None]
+    ids = np.select(
+        [ys < ground_y, ys == ground_y, ys < ground_y + 4 + stone_offset],
+        [0, Tiles.GRASS.id, Tiles.DIRT.id],
+        Tiles.STONE.id,
+    ).astype(np.uint16)
+
+    trees = plan_trees(rng, ground_y, x0)
+
+    plants = rng.random(width) > 0.7
+    plants[trees[:, 0] - x0] = False
+    plant_xs = np.nonzero(plants)[0]
+    plant_ys = ground_y[plant_xs] - 1
+    inside = plant_ys >= 0
+    ids[plant_ys[inside], plant_xs[inside]] = Tiles.GRASS_PLANT.id
+
+    return ids, trees
+
+
+def chunk_trees(seed: int, chunk_index: int, width: int, height: int) -> np.ndarray:
+    """
+    The trees generate_chunk would return, without generating the terrain
+    """
+    x0 = chunk_index * GEN_CHUNK_WIDTH
+    ground_y = ground_heights(
+        opensimplex.OpenSimplex(seed), np.arange(x0, x0 + width), height
+    )
+    return plan_trees(chunk_rng(seed, chunk_index), ground_y, x0)
+
+
+def tree_cells(trees: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (xs, ys, ids) of every cell of the trees from plan_trees
+    """
+    xs, ys, bark_lengths = trees.T
+    cell_xs, cell_ys, cell_ids = [], [], []
+    for bark_length, (dy, dx, ids) in TREE_STAMPS.items():
+        selected = bark_lengths == bark_length
+        cell_xs.append((xs[selected][:, None] + dx).ravel())
+        cell_ys.append((ys[selected][:, None] + dy).ravel())
+        cell_ids.append(np.tile(ids, np.count_nonzero(selected)))
+    return np.concatenate(cell_xs), np.concatenate(cell_ys), np.concatenate(cell_ids)
+
+
+def generate_chunk_shared(
+    shm_name: str, shape: tuple[int, int], seed: int, chunk_index: int
+) -> np.ndarray:
+    """
+    Worker side of WorldGenerator.generate_parallel, writes the chunk straight
+    into the shared grid and only sends the trees back
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        grid = np.ndarray(shape, dtype=np.uint16, buffer=shm.buf)
+        x0 = chunk_index * GEN_CHUNK_WIDTH
+        width = min(GEN_CHUNK_WIDTH, shape[1] - x0)
+        ids, trees = generate_chunk(seed, chunk_index, width, shape[0])
+        grid[:, x0 : x0 + width] = ids
+        del grid
+    finally:
+        shm.close()
+    return trees
+
 
 class WorldGenerator():
-    def __init__(self, tilemap):
+    def __init__(self, tilemap, seed: Optional[int] = None):
         self.tilemap = tilemap
-        
-    def generate_tiles(self):
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.tilemap.seed = self.seed
+
+    def generate_tiles(
+        self,
+        progress: Optional[Callable[[float], None]] = None,
+        workers: Optional[int] = None,
+    ):
+        """
+        progress gets called with the fraction of chunks done after every chunk.
+        workers defaults to the cpu count, the world comes out the same for any amount
+        """
         start_time = time.time()
-        seed = random.randint(0, 1 << 64)
-        opensimplex.seed(seed)
-        random.seed(seed)
-        base_ground_y = self.tilemap.height // 2
-        last_tree = -1
-        for x in range(self.tilemap.width):
-            ground_y = int(opensimplex.noise2(x / 15, 0) * 8) + base_ground_y
-            stone_offset = int(opensimplex.noise2(x / 20, 2) * 5)
-            self.tilemap.set_tile((x, ground_y), Tiles.GRASS)
-
-            if last_tree + 1 < x and random.random() > 0.95:
-                last_tree = x
-                self.generate_tree(
-                    pg.Vector2(x, ground_y - 1),
-                    bark_length=random.choices([1, 2, 3, 4], weights=(1, 3, 3, 1))[0],
-                )
-            if random.random() > 0.7:
-                self.tilemap.set_tile(
-                    (x, ground_y - 1), Tiles.GRASS_PLANT, replace=False
+        width, height = self.tilemap.width, self.tilemap.height
+        chunk_count = -(-width // GEN_CHUNK_WIDTH)
+        workers = min(workers or os.cpu_count() or 1, chunk_count)
+
+        if workers > 1:
+            trees = self.generate_parallel(chunk_count, workers, progress)
+        else:
+            trees = []
+            for chunk_index in range(chunk_count):
+                x0 = chunk_index * GEN_CHUNK_WIDTH
+                ids, new_trees = generate_chunk(
+                    self.seed, chunk_index, min(GEN_CHUNK_WIDTH, width - x0), height
                 )
-            # for water_y in range(base_ground_y, ground_y - 2, 1):
-            # self.tilemap.set_tile((x, water_y), Tiles.WATER, False)
-
-            for y in range(ground_y + 1, self.tilemap.height):
-                if y < ground_y + 4 + stone_offset:
-                    self.tilemap.set_tile((x, y), Tiles.DIRT)
-                else:
-                    self.tilemap.set_tile((x, y), Tiles.STONE)
-
-            if x % (self.tilemap.width // 100) == 0:
-                print(f"{round(x / self.tilemap.width * 100)}%")
-                pg.display.flip()
-        print(f"100%\nworldgen done, time:{time.time()-start_time:.2f}s")
-
-    def generate_tree(self, pos: Coordinate, bark_length: int = 2) -> None:
-        leaf_t = Tiles.LEAF
-        bark_t = Tiles.WOOD
-        leafs = [
-            [None, leaf_t, leaf_t, leaf_t, None],
-            [leaf_t, leaf_t, leaf_t, leaf_t, leaf_t],
-            [leaf_t, leaf_t, leaf_t, leaf_t, leaf_t],
-        ]
-        bark = [[None, None, bark_t, None, None]] * bark_length
-        tree = leafs + bark
-
-        self.tilemap.set_tiles(
-            (pos - pg.Vector2(2, bark_length + 2)), tree, replace=False
-        )
+                self.tilemap.set_region((x0, 0), ids)
+                trees.append(new_trees)
+                if progress is not None:
+                    progress((chunk_index + 1) / chunk_count)
+
+        # trees go in once every chunk exists, in chunk order so the result
+        # doesn't depend on which worker finished first
+        self.generate_trees(np.concatenate(trees))
+        print(f"worldgen done, time:{time.time()-start_time:.2f}s")
+
+    def generate_parallel(
+        self,
+        chunk_count: int,
+        workers: int,
+        progress: Optional[Callable[[float], None]] = None,
+    ) -> list[np.ndarray]:
+        shape = self.tilemap.grid.shape
+        shm = shared_memory.SharedMemory(create=True, size=self.tilemap.grid.nbytes)
+        try:
+            trees: list[np.ndarray] = [None] * chunk_count
+            with ProcessPoolExecutor(workers) as executor:
+                futures = {
+                    executor.submit(
+                        generate_chunk_shared, shm.name, shape, self.seed, chunk_index
+                    ): chunk_index
+                    for chunk_index in range(chunk_count)
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    trees[futures[future]] = future.result()
+                    if progress is not None:
+                        progress(done / chunk_count)
+
+            grid = np.ndarray(shape, dtype=np.uint16, buffer=shm.buf)
+            self.tilemap.set_region((0, 0), grid)
+            del grid
+        finally:
+            shm.close()
+            shm.unlink()
+        return trees
 
+    def generate_trees(self, trees: np.ndarray) -> None:
+        """
+        Stamps trees from plan_trees, only into empty cells
+        """
+        self.tilemap.set_cells(*tree_cells(trees), replace=False)